@@ -1,3 +1,5 @@
+import math
+
 import fjformer.attention
 from jax.interpreters import pxla
 from jax.experimental.pjit import with_sharding_constraint as wsc
@@ -120,6 +122,9 @@ def get_gradient_checkpoint_policy(name):
     :return: A function that is used in the jax
     
     """
+    if name == 'offload_dot_with_no_batch_dims':
+        # keeps the saved dots in pinned host memory instead of recomputing them
+        return jax.checkpoint_policies.offload_dot_with_no_batch_dims('device', 'pinned_host')
     gradients = dict(
         everything_saveable=jax.checkpoint_policies.everything_saveable,
         nothing_saveable=jax.checkpoint_policies.nothing_saveable,
@@ -135,6 +140,21 @@ def get_gradient_checkpoint_policy(name):
     return gradients[name]
 
 
+def get_sqrt_remat_group_size(num_layers: int) -> int:
+    """
+    The get_sqrt_remat_group_size function returns sqrt(num_layers) rounded, which is the number of consecutive
+    layers to put under one outer checkpoint for the sqrt(L) nested rematerialization. Only the inputs of the
+    ceil(L / k) groups and the k layers of the group being recomputed are kept alive, so the peak activation memory is
+    O(sqrt(L)) for about one extra forward pass. The last group is shorter when k does not divide L, a divisor of L
+    would degrade to groups of a single layer when L is prime.
+
+    :param num_layers: int: Number of layers in the stack
+    :return: The size of each group of layers (the last group may be smaller)
+    
+    """
+    return max(1, round(math.sqrt(num_layers)))
+
+
 def repeat_kv_bnsh(x: chex.Array, n_rep: int) -> chex.Array:
     """
     The repeat_kv_bnsh function is used to repeat the key and value vectors for each head in a multi-head attention
@@ -281,15 +281,6 @@ class FlaxGPTNeoXBlock(nn.Module):
         return hidden_states
 
 
-def get_gradient_checkpoint_policy(name):
-    return {
-        'everything_saveable': jax.checkpoint_policies.everything_saveable,
-        'nothing_saveable': jax.checkpoint_policies.nothing_saveable,
-        'checkpoint_dots': jax.checkpoint_policies.checkpoint_dots,
-        'checkpoint_dots_with_no_batch_dims': jax.checkpoint_policies.checkpoint_dots_with_no_batch_dims,
-    }[name]
-
-
 class FlaxGPTNeoXCollection(nn.Module):
     config: GPTNeoXConfig
     dtype: jnp.dtype = jnp.float32
@@ -20,6 +20,7 @@ from transformers.modeling_flax_outputs import FlaxBaseModelOutput, FlaxCausalLM
 from ..flax_modelling_utils import (
     with_sharding_constraint,
     get_gradient_checkpoint_policy,
+    get_sqrt_remat_group_size,
     repeat_kv_bnsh,
     apply_rotary_pos_emb,
     precompute_freq_cis,
@@ -1169,6 +1170,20 @@ class FlaxLlamaBlockCollection(nn.Module):
         else:
             fcm_mask = None
 
+        if getattr(self.config, 'gradient_checkpointing_policy', 'full') == 'sqrt' and not (
+                init_cache or output_attentions or output_hidden_states
+        ):
+            hidden_states = self._sqrt_remat_blocks(
+                hidden_states=hidden_states,
+                freq_cis=freq_cis,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                causal_mask=causal_mask,
+                deterministic=deterministic,
+                fcm_mask=fcm_mask,
+            )
+            return hidden_states, all_hidden_states, all_attentions
+
         for block in self.blocks:
             if output_hidden_states:
                 all_hidden_states += (hidden_states,)
@@ -1193,6 +1208,55 @@ class FlaxLlamaBlockCollection(nn.Module):
 
         return outputs
 
+    def _sqrt_remat_blocks(
+            self,
+            hidden_states: chex.Array,
+            freq_cis: chex.Array,
+            attention_mask: chex.Array,
+            position_ids: chex.Array,
+            causal_mask: chex.Array,
+            deterministic: bool = True,
+            fcm_mask: Optional[jnp.ndarray] = None,
+    ):
+        """
+        The _sqrt_remat_blocks function runs the blocks in groups of about sqrt(num_hidden_layers) and checkpoints
+        every group as a whole on top of the per block rematerialization, so the backward pass only keeps the group
+        inputs and the layers of the group it is currently recomputing.
+
+        :param self: Represent the instance of the class
+        :param hidden_states: chex.Array: Pass the input tensor to the blocks
+        :param freq_cis: chex.Array: Pass in the frequency of each token
+        :param attention_mask: chex.Array: Mask out certain tokens in the input sequence
+        :param position_ids: chex.Array: Specify the position of each token in a sequence
+        :param causal_mask: chex.Array: Mask the attention weights
+        :param deterministic: bool: Determine whether the model is in training or evaluation mode
+        :param fcm_mask: Optional[jnp.ndarray]: The forgetful causal mask if one is used
+        :return: The hidden states of the last block
+
+        """
+        group_size = get_sqrt_remat_group_size(len(self.blocks))
+        for start in range(0, len(self.blocks), group_size):
+            def run_group(collection, hidden_states_, freq_cis_, attention_mask_, position_ids_, causal_mask_,
+                          fcm_mask_, start_=start):
+                for block in collection.blocks[start_:start_ + group_size]:
+                    hidden_states_ = block(
+                        hidden_states=hidden_states_,
+                        freq_cis=freq_cis_,
+                        attention_mask=attention_mask_,
+                        position_ids=position_ids_,
+                        causal_mask=causal_mask_,
+                        deterministic=deterministic,
+                        init_cache=False,
+                        output_attentions=False,
+                        fcm_mask=fcm_mask_,
+                    )[0]
+                return hidden_states_
+
+            hidden_states = nn.remat(run_group, policy=jax.checkpoint_policies.nothing_saveable)(
+                self, hidden_states, freq_cis, attention_mask, position_ids, causal_mask, fcm_mask
+            )
+        return hidden_states
+
 
 class FlaxLlamaModule(nn.Module):
     config: LlamaConfig
@@ -232,7 +232,7 @@ class FlaxOPTAttention(nn.Module):
         is_initialized = self.has_variable("cache", "cached_key")
         cached_key = self.variable("cache", "cached_key", jnp.zeros, key.shape, key.dtype)
         cached_value = self.variable("cache", "cached_value", jnp.zeros, value.shape, value.dtype)
-        cache_index = self.variable("cache", "cache_index", lambda: chex.Array(0, dtype=jnp.int32))
+        cache_index = self.variable("cache", "cache_index", lambda: jnp.array(0, dtype=jnp.int32))
 
         if is_initialized:
             *batch_dims, max_length, num_heads, depth_per_head = cached_key.value.shape
@@ -303,39 +303,41 @@ class FlaxOPTAttention(nn.Module):
         elif attention_mask is not None:
             attention_mask = jnp.expand_dims(attention_mask, axis=(-3, -2))
 
+        # `init_cache` and the presence of the cache are static, so prefill and decode each trace to their own graph
         if self.causal and (self.has_variable("cache", "cached_key") or init_cache):
             key_states, value_states, attention_mask = self._concatenate_to_cache(
                 key_states, value_states, query_states, attention_mask
             )
-            if attention_mask is not None:
-                attention_bias = lax.select(
-                    attention_mask > 0,
-                    jnp.full(attention_mask.shape, 0.0).astype(self.dtype),
-                    jnp.full(attention_mask.shape, jnp.finfo(self.dtype).min).astype(self.dtype),
-                )
-            else:
-                attention_bias = None
-
-            dropout_rng = None
-            if not deterministic and self.dropout > 0.0:
-                dropout_rng = self.make_rng("dropout")
-
-            attn_weights = dot_product_attention_weights(
-                query_states,
-                key_states,
-                bias=attention_bias,
-                dropout_rng=dropout_rng,
-                dropout_rate=self.dropout,
-                broadcast_dropout=True,
-                deterministic=deterministic,
-                dtype=self.dtype,
-                precision=None,
+
+        if attention_mask is not None:
+            attention_bias = lax.select(
+                attention_mask > 0,
+                jnp.full(attention_mask.shape, 0.0).astype(self.dtype),
+                jnp.full(attention_mask.shape, jnp.finfo(self.dtype).min).astype(self.dtype),
             )
-            if self.config.use_pjit_attention_force:
-                attn_weights = with_sharding_constraint(attn_weights, PartitionSpec(('dp', 'fsdp'), 'mp', None, None))
-            attn_output = jnp.einsum("...hqk,...khd->...qhd", attn_weights, value_states)
-            attn_output = self._merge_heads(attn_output)
-            attn_output = self.out_proj(attn_output)
+        else:
+            attention_bias = None
+
+        dropout_rng = None
+        if not deterministic and self.dropout > 0.0:
+            dropout_rng = self.make_rng("dropout")
+
+        attn_weights = dot_product_attention_weights(
+            query_states,
+            key_states,
+            bias=attention_bias,
+            dropout_rng=dropout_rng,
+            dropout_rate=self.dropout,
+            broadcast_dropout=True,
+            deterministic=deterministic,
+            dtype=self.dtype,
+            precision=None,
+        )
+        if self.config.use_pjit_attention_force:
+            attn_weights = with_sharding_constraint(attn_weights, PartitionSpec(('dp', 'fsdp'), 'mp', None, None))
+        attn_output = jnp.einsum("...hqk,...khd->...qhd", attn_weights, value_states)
+        attn_output = self._merge_heads(attn_output)
+        attn_output = self.out_proj(attn_output)
 
         return attn_output, attn_weights
 
@@ -631,15 +633,27 @@ class FlaxOPTPreTrainedModel(FlaxPreTrainedModel):
             return random_params
 
     def init_cache(self, batch_size, max_length):
-
+        """
+        The init_cache function preallocates the `(batch_size, max_length, num_heads, head_dim)` key/value buffers
+        of every layer, which the attention layers then fill in place with `lax.dynamic_update_slice`.
+        Only the shapes of the cache are traced (`jax.eval_shape`), so no forward pass or parameter init is executed.
+
+        :param self: Access variables that belong to the class
+        :param batch_size: Define the batch size of the cache
+        :param max_length: Set the length of the cache
+        :return: The zero initialized cache collection
+        """
         input_ids = jnp.ones((batch_size, max_length), dtype="i4")
         attention_mask = jnp.ones_like(input_ids, dtype="i4")
         position_ids = jnp.broadcast_to(jnp.arange(jnp.atleast_2d(input_ids).shape[-1]), input_ids.shape)
 
-        init_variables = self.module.init(
-            jax.random.PRNGKey(0), input_ids, attention_mask, position_ids, return_dict=False, init_cache=True
+        init_variables = jax.eval_shape(
+            partial(self.module.init, return_dict=False, init_cache=True),
+            jax.random.PRNGKey(0), input_ids, attention_mask, position_ids
+        )
+        return jax.tree_util.tree_map(
+            lambda x: jnp.zeros(x.shape, dtype=x.dtype), unfreeze(init_variables["cache"])
         )
-        return unfreeze(init_variables["cache"])
 
     def __call__(
             self,
@@ -751,18 +765,39 @@ class FlaxOPTModel(FlaxOPTPreTrainedModel):
     module_class = FlaxOPTModule
 
 
+def _pack_output(lm_logits, outputs, return_dict: bool):
+    """
+    The _pack_output function packs the logits with the decoder outputs. The `FlaxMaskedLMOutput` dataclass is
+    only constructed when the caller asked for a dict, otherwise a plain tuple with the same pytree layout as the
+    decoder outputs is returned.
+
+    :param lm_logits: The logits of the lm head
+    :param outputs: The outputs of the decoder, either a tuple or a `FlaxBaseModelOutput`
+    :param return_dict: bool: Return a `FlaxMaskedLMOutput` instead of a tuple
+    :return: The packed outputs
+    """
+    if not return_dict:
+        return (lm_logits,) + tuple(outputs[1:])
+    return FlaxMaskedLMOutput(
+        logits=lm_logits,
+        hidden_states=outputs.hidden_states,
+        attentions=outputs.attentions,
+    )
+
+
 class FlaxOPTForCausalLMModule(nn.Module):
     config: OPTConfig
     dtype: jnp.dtype = jnp.float32
 
     def setup(self):
         self.model = FlaxOPTModule(config=self.config, dtype=self.dtype)
-        self.lm_head = nn.Dense(
-            self.config.vocab_size,
-            use_bias=False,
-            dtype=self.dtype,
-            kernel_init=jax.nn.initializers.normal(self.config.init_std),
-        )
+        if not self.config.tie_word_embeddings:
+            self.lm_head = nn.Dense(
+                self.config.vocab_size,
+                use_bias=False,
+                dtype=self.dtype,
+                kernel_init=jax.nn.initializers.normal(self.config.init_std),
+            )
 
     def __call__(
             self,
@@ -775,6 +810,9 @@ class FlaxOPTForCausalLMModule(nn.Module):
             return_dict: bool = True,
             deterministic: bool = True,
     ):
+        if init_cache:
+            assert not (output_hidden_states or output_attentions), 'hidden states and attentions are not ' \
+                                                                    'collected while initializing the cache'
         outputs = self.model(
             input_ids,
             attention_mask,
@@ -790,37 +828,99 @@ class FlaxOPTForCausalLMModule(nn.Module):
 
         if self.config.tie_word_embeddings:
             shared_embedding = self.model.variables["params"]["decoder"]["embed_tokens"]["embedding"]
-            lm_logits = self.lm_head.apply({"params": {"kernel": shared_embedding.T}}, hidden_states)
+            # while sampling (the cache is being updated) the vocab x hidden table is the memory bound operand and
+            # the logits only feed a softmax, so it is read in bf16 on accelerators, training and cpu keep self.dtype
+            sampling = self.is_mutable_collection('cache') and not init_cache and jax.default_backend() != 'cpu'
+            head_dtype = jnp.bfloat16 if sampling else self.dtype
+            lm_logits = jnp.einsum(
+                "bsd,vd->bsv",
+                hidden_states.astype(head_dtype),
+                shared_embedding.astype(head_dtype),
+                precision=lax.Precision.DEFAULT
+            )
         else:
             lm_logits = self.lm_head(hidden_states)
 
-        if not return_dict:
-            return (lm_logits,) + outputs[1:]
+        lm_logits = lm_logits.astype(jnp.float32)
 
-        return FlaxMaskedLMOutput(
-            logits=lm_logits,
-            hidden_states=outputs.hidden_states,
-            attentions=outputs.attentions,
-        )
+        return _pack_output(lm_logits, outputs, return_dict)
+
+
+def _cumsum_minus_one(mask):
+    """
+    The _cumsum_minus_one function computes `mask.cumsum(axis=1) - 1` as a parallel prefix sum, which XLA lowers to
+    elementwise adds it can fuse with the following subtraction instead of a standalone cumsum reduction.
+
+    :param mask: The `(batch_size, seq_length)` int32 attention mask
+    :return: The position ids of every token
+    """
+    return lax.associative_scan(jnp.add, mask, axis=1) - 1
+
+
+@partial(jax.jit, static_argnums=(1,))
+def _prepare_generation_masks(attention_mask, max_length: int):
+    """
+    The _prepare_generation_masks function builds the static `(batch_size, max_length)` attention mask and the
+    position ids of the prompt. It's jitted with `max_length` static, so repeated `generate` calls with the same
+    shapes hit the compilation cache instead of tracing the cumsum and update slice again.
+
+    :param attention_mask: The `(batch_size, seq_length)` attention mask of the prompt
+    :param max_length: int: Set the length of the extended attention mask
+    :return: A tuple of the extended attention mask and the position ids
+    """
+    attention_mask = attention_mask.astype("i4")
+    with jax.named_scope("gen_positions"):
+        position_ids = lax.stop_gradient(_cumsum_minus_one(attention_mask))
+    if attention_mask.shape[1] == max_length:
+        # the caller already padded the mask up to max_length, so there is nothing to write into
+        return attention_mask, position_ids
+    extended_attention_mask = lax.dynamic_update_slice(
+        jnp.ones((attention_mask.shape[0], max_length), dtype="i4"), attention_mask, (0, 0)
+    )
+    return extended_attention_mask, position_ids
 
 
 class FlaxOPTForCausalLM(FlaxOPTPreTrainedModel):
     module_class = FlaxOPTForCausalLMModule
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._kv_cache_cache: dict = {}
+
+    def _get_generation_cache(self, batch_size, max_length):
+        """
+        The _get_generation_cache function returns a zero initialized cache for the given shape and reuses it across
+        `generate` calls, since the arrays are immutable and each call only writes into its own updated copy.
+        There's no need to zero it again either, the causal mask keeps the unwritten slots out of the attention.
+        Only the cache of the last shape is kept, so varying batch sizes or lengths never pile up caches.
+
+        :param self: Access variables that belong to the class
+        :param batch_size: Define the batch size of the cache
+        :param max_length: Set the length of the cache
+        :return: The cache collection
+        """
+        key = (batch_size, max_length, self.dtype)
+        past_key_values = self._kv_cache_cache.get(key)
+        if past_key_values is None:
+            past_key_values = self.init_cache(batch_size, max_length)
+            if not any(isinstance(leaf, jax.core.Tracer) for leaf in jax.tree_util.tree_leaves(past_key_values)):
+                # a cache created while `generate` itself is being traced must not leak out of that trace
+                self._kv_cache_cache.clear()
+                self._kv_cache_cache[key] = past_key_values
+        return past_key_values
+
     def prepare_inputs_for_generation(self, input_ids, max_length, attention_mask: Optional[chex.Array] = None):
         # initializing the cache
         batch_size, seq_length = input_ids.shape
 
-        past_key_values = self.init_cache(batch_size, max_length)
+        past_key_values = self._get_generation_cache(batch_size, max_length)
         # Note that usually one would have to put 0's in the attention_mask for x > input_ids.shape[-1] and x < cache_length.
         # But since the decoder uses a causal mask, those positions are masked anyway.
         # Thus, we can create a single static attention_mask here, which is more efficient for compilation
-        extended_attention_mask = jnp.ones((batch_size, max_length), dtype="i4")
-
         if attention_mask is not None:
-            position_ids = attention_mask.cumsum(axis=1) - 1
-            extended_attention_mask = lax.dynamic_update_slice(extended_attention_mask, attention_mask, (0, 0))
+            extended_attention_mask, position_ids = _prepare_generation_masks(attention_mask, max_length)
         else:
+            extended_attention_mask = jnp.ones((batch_size, max_length), dtype="i4")
             position_ids = jnp.broadcast_to(jnp.arange(seq_length, dtype="i4")[None, :], (batch_size, seq_length))
 
         return {
@@ -831,5 +931,10 @@ class FlaxOPTForCausalLM(FlaxOPTPreTrainedModel):
 
     def update_inputs_for_generation(self, model_outputs, model_kwargs):
         model_kwargs["past_key_values"] = model_outputs.past_key_values
-        model_kwargs["position_ids"] = model_kwargs["position_ids"][:, -1:] + 1
+        position_ids = model_kwargs["position_ids"]
+        if position_ids.shape[1] != 1:
+            # only the prefill step carries (batch_size, seq_length) positions, every decode step after it
+            # already holds a (batch_size, 1) column which is just incremented in place
+            position_ids = position_ids[:, -1:]
+        model_kwargs["position_ids"] = position_ids + 1
         return model_kwargs
@@ -219,15 +219,6 @@ class ParallelPalmBlock(nn.Module):
         return attn_out + ff_out
 
 
-def get_gradient_checkpoint_policy(name):
-    return {
-        'everything_saveable': jax.checkpoint_policies.everything_saveable,
-        'nothing_saveable': jax.checkpoint_policies.nothing_saveable,
-        'checkpoint_dots': jax.checkpoint_policies.checkpoint_dots,
-        'checkpoint_dots_with_no_batch_dims': jax.checkpoint_policies.checkpoint_dots_with_no_batch_dims,
-    }[name]
-
-
 class ParallelCollection(nn.Module):
     config: PalmConfig
     dtype: jnp.dtype = jnp.bfloat16
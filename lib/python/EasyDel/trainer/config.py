@@ -20,6 +20,8 @@ AVAILABLE_GRADIENT_CHECK_POINTING: List[str] = ['everything_saveable',
                                                 'nothing_saveable',
                                                 'checkpoint_dots',
                                                 'checkpoint_dots_with_no_batch_dims']
+AVAILABLE_GRADIENT_CHECKPOINTING_POLICIES: List[str] = ['none', 'full', 'sqrt', 'offload']
+SQRT_REMAT_MODEL_TYPES: List[str] = ['llama']
 AVAILABLE_BACKENDS: List[str] = [
     'cpu', 'gpu', 'tpu', None
 ]
@@ -43,6 +45,7 @@ class TrainArguments(
             gradient_accumulation_steps: int = 1,
             weight_decay: float = 0.01,
             gradient_checkpointing: str = 'nothing_saveable',
+            gradient_checkpointing_policy: str = 'full',
             max_length: Union[int, None] = 4096,
             sharding_array: Union[tuple, int] = (1, -1, 1, 1),
             is_fine_tuning: bool = True,
@@ -73,6 +76,8 @@ class TrainArguments(
             warmup_steps: int = 500,
             init_input_shape: typing.Tuple[int, int] = (1, 1),
             step_partition_spec: jax.sharding.PartitionSpec = jax.sharding.PartitionSpec(('dp', 'fsdp'), 'mp'),
+            log_steps: int = 10,
+            dataloader_num_workers: int = 0,
             **kwargs
     ):
         """
@@ -96,6 +101,9 @@ class TrainArguments(
         :param gradient_accumulation_steps: int: Accumulate gradients over multiple batches
         :param weight_decay: float: Control the weight decay
         :param gradient_checkpointing: str: Control the gradient checkpointing method
+        :param gradient_checkpointing_policy: str: How the layer stack is rematerialized, `none` disables it, `full`
+         checkpoints every layer with `gradient_checkpointing`, `sqrt` nests the layers in groups of sqrt(num layers)
+         (llama models only, other models raise an error) and `offload` offloads the saved dots to host memory
         :param max_length: Union[int, None]: Set the maximum length of a sequence, Pass the model_class to the trainer class
         :param sharding_array: Union[tuple: Shard the model across multiple devices
         :param is_fine_tuning: bool: Determine whether the model is being trained from scratch or not
@@ -108,7 +116,8 @@ class TrainArguments(
         :param save_dir: str: Specify the directory where the model checkpoints will be saved
         :param use_pjit_attention_force: bool: Determine whether to use the jax
         :param dtype: Set the data type of the model parameters and inputs
-        :param param_dtype: Specify the data type of the model parameters
+        :param param_dtype: Specify the data type of the model parameters (and of the optimizer states), use
+        jnp.float32 to keep fp32 master weights while computing in dtype
         :param fully_fsdp: Control the use of fully fused sdp
         :param use_wandb: bool: Determine whether to use wandb or not
         :param custom_rule: Pass a custom rule to the optimizer,
@@ -120,12 +129,16 @@ class TrainArguments(
         :param model_parameters: Pass the model parameters to the trainer
         :param do_shard_fns: bool: Shard the model across multiple devices
         :param track_memory: bool: Track the memory usage of the model
-        :param loss_remat: str: Specify how to rematerialize the loss function
-        :param loss_chunk: int: Chunk the loss function
+        :param loss_remat: str: Specify how to rematerialize the loss function, `FUSED_LCE` fuses the lm_head
+         projection into a chunked cross entropy so the full logits are never materialized (needs an untied `lm_head`)
+        :param loss_chunk: int: Chunk the loss function, also the number of tokens per chunk for `FUSED_LCE`
         :param is_left_padded: bool: Indicate whether the input is left padded or not
         :param warmup_steps: int: Warm up the learning rate
         :param init_input_shape: typing.Tuple[int]: Initialize the input shape of the model
         :param step_partition_spec: jax.sharding.PartitionSpec: PartitionSpec Custom to be used in training and eval or test loop
+        :param log_steps: int: Number of training steps between two syncs of the metrics to the host for logging
+        :param dataloader_num_workers: int: Number of (spawned) worker processes collating the batches, 0 collates
+        them in the training process
         :param **kwargs: Pass a variable number of keyword arguments to a function
         :return: Nothing
         
@@ -144,6 +157,9 @@ class TrainArguments(
                                                                             f'recognized, available gradient ' \
                                                                             f'checkpointing methods are ' \
                                                                             f'{AVAILABLE_GRADIENT_CHECK_POINTING}'
+        assert gradient_checkpointing_policy in AVAILABLE_GRADIENT_CHECKPOINTING_POLICIES, \
+            f'{gradient_checkpointing_policy} is not recognized, available gradient checkpointing policies are ' \
+            f'{AVAILABLE_GRADIENT_CHECKPOINTING_POLICIES}'
         assert scheduler in AVAILABLE_SCHEDULERS, f'{scheduler} is not recognized, ' \
                                                   f'available schedulers are {AVAILABLE_SCHEDULERS}'
         assert optimizer in AVAILABLE_OPTIMIZERS, f'{optimizer} is not recognized, ' \
@@ -165,6 +181,7 @@ class TrainArguments(
         self.weight_decay = weight_decay
         self.model_name = model_name
         self.gradient_checkpointing = gradient_checkpointing
+        self.gradient_checkpointing_policy = gradient_checkpointing_policy
         self.max_length = max_length
         self.sharding_array = sharding_array
         self.is_fine_tuning = is_fine_tuning
@@ -196,6 +213,8 @@ class TrainArguments(
         self.init_input_shape = init_input_shape
         self.is_left_padded = is_left_padded
         self.step_partition_spec = step_partition_spec
+        self.log_steps = log_steps
+        self.dataloader_num_workers = dataloader_num_workers
         torch.set_default_device('cpu')
         self.__dict__.update(**kwargs)
 
@@ -237,16 +256,8 @@ class TrainArguments(
     def __str__(self):
         string = f'TrainingArguments(\n'
         for k, v in self.__call__().items():
-            if isinstance(v, typing.Callable):
-                def string_func(it_self):
-                    string_ = f'{it_self.__class__.__name__}(\n'
-                    for k_, v_ in it_self.__dict__.items():
-                        string_ += f'\t\t{k_} : {v_}\n'
-                    string_ += '\t)'
-                    return string_
-
-                v.__str__ = string_func
-                v = v.__str__(v)
+            if callable(v):
+                v = f'<callable {getattr(v, "__name__", type(v).__name__)}>'
             string += f'\t{k} : {v}\n'
         string += ')'
         return string
@@ -472,6 +483,21 @@ class TrainArguments(
         return StreamingCheckpointer(StreamingCheckpointer.get_default_config(),
                                      os.path.join(self.save_dir, self.model_name))
 
+    def get_gradient_checkpointing(self):
+        """
+        The get_gradient_checkpointing function resolves `gradient_checkpointing_policy` into the
+        `gradient_checkpointing` name that the model configs expect.
+
+        :param self: Represent the instance of the class
+        :return: The gradient checkpointing name to pass to the model config
+        
+        """
+        if self.gradient_checkpointing_policy == 'none':
+            return ''
+        elif self.gradient_checkpointing_policy == 'offload':
+            return 'offload_dot_with_no_batch_dims'
+        return self.gradient_checkpointing
+
     def get_board(self):
         """
         The get_board function is a helper function that returns a TensorBoard object.
@@ -1,7 +1,10 @@
 import dataclasses
+import functools
+import math
 import os
 import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 
 import IPython.display
 import fjformer.func.loss_func
@@ -9,10 +12,11 @@ from fjformer.func.loss_func import fused_cross_entropy_loss_and_accuracy, cross
 import wandb
 from datasets import Dataset
 
-from .config import TrainArguments
+from .config import TrainArguments, SQRT_REMAT_MODEL_TYPES
 
 import jax
 import flax
+import numpy as np
 from transformers import FlaxAutoModelForCausalLM, AutoConfig
 from tqdm import tqdm
 from ..utils.utils import Timers, prefix_print
@@ -48,6 +52,67 @@ def calculate_accuracy(predictions: chex.Array, targets: chex.Array):
     return accuracy
 
 
+def chunked_linear_cross_entropy_loss_and_accuracy(
+        hidden_states: chex.Array,
+        kernel: chex.Array,
+        labels: chex.Array,
+        weights: chex.Array,
+        chunk_size: int = 1024,
+        bias: typing.Optional[chex.Array] = None
+):
+    """
+    The chunked_linear_cross_entropy_loss_and_accuracy function fuses the lm_head projection with the cross entropy
+    loss. The sequence is scanned in chunks of `chunk_size` tokens and every chunk is rematerialized in the backward
+    pass, so only a `(batch_size, chunk_size, vocab_size)` slice of logits is alive at any time instead of the full
+    `(batch_size, seq_length, vocab_size)` tensor and its gradient. The loss and accuracy are normalized the same
+    way as `cross_entropy_loss_and_accuracy` (per sequence, then averaged over the batch).
+
+    :param hidden_states: chex.Array: The `(batch_size, seq_length, hidden_dim)` final hidden states of the model
+    :param kernel: chex.Array: The `(hidden_dim, vocab_size)` kernel of the lm_head
+    :param labels: chex.Array: The `(batch_size, seq_length)` target token ids
+    :param weights: chex.Array: The `(batch_size, seq_length)` mask of tokens that count in the loss
+    :param chunk_size: int: Number of tokens projected to the vocab at once
+    :param bias: typing.Optional[chex.Array]: The bias of the lm_head if it has one
+    :return: A tuple of the loss and the accuracy
+
+    """
+    batch_size, seq_length, hidden_dim = hidden_states.shape
+    num_chunks = -(-seq_length // chunk_size)
+    pad = num_chunks * chunk_size - seq_length
+    if pad:
+        hidden_states = jnp.pad(hidden_states, ((0, 0), (0, pad), (0, 0)))
+        labels = jnp.pad(labels, ((0, 0), (0, pad)))
+        weights = jnp.pad(weights, ((0, 0), (0, pad)))
+    weights = weights.astype(jnp.float32)
+
+    def to_chunks(x):
+        return jnp.moveaxis(x.reshape((batch_size, num_chunks, chunk_size) + x.shape[2:]), 1, 0)
+
+    @jax.checkpoint
+    def chunk_loss(kernel_, hidden_chunk, label_chunk, weight_chunk):
+        logits = jnp.dot(hidden_chunk, kernel_.astype(hidden_chunk.dtype)).astype(jnp.float32)
+        if bias is not None:
+            logits = logits + bias.astype(jnp.float32)
+        log_z = jax.nn.logsumexp(logits, axis=-1)
+        target_logits = jnp.take_along_axis(logits, label_chunk[..., None], axis=-1)[..., 0]
+        correct = (jnp.argmax(logits, axis=-1) == label_chunk).astype(jnp.float32)
+        return jnp.sum((log_z - target_logits) * weight_chunk, axis=-1), jnp.sum(correct * weight_chunk, axis=-1)
+
+    def scan_fn(carry, chunk):
+        loss_sum, correct_sum = carry
+        chunk_loss_sum, chunk_correct_sum = chunk_loss(kernel, *chunk)
+        return (loss_sum + chunk_loss_sum, correct_sum + chunk_correct_sum), None
+
+    init = (jnp.zeros((batch_size,), jnp.float32), jnp.zeros((batch_size,), jnp.float32))
+    (loss_sum, correct_sum), _ = jax.lax.scan(
+        scan_fn, init, (to_chunks(hidden_states), to_chunks(labels), to_chunks(weights))
+    )
+    valid_text_length = jnp.maximum(jnp.sum(weights, axis=-1), 1e-10)
+    loss = jnp.mean(loss_sum / valid_text_length)
+    accuracy = jnp.mean(correct_sum / valid_text_length)
+    return loss, accuracy
+
+
 def create_fsdp_train_step(partition_spec=PartitionSpec(('dp', 'fsdp'), 'mp')):
     """
     The create_fsdp_train_step function is a training step function that takes in the current state of the model,
@@ -78,7 +143,7 @@ def create_fsdp_train_step(partition_spec=PartitionSpec(('dp', 'fsdp'), 'mp')):
                                     return_dict=True).logits
 
             loss, accuracy = cross_entropy_loss_and_accuracy(
-                logits[:, :-1, :], labels, batch['attention_mask'].astype(jnp.float32)[:, 1:]
+                logits[:, :-1, :], labels, batch['attention_mask'][:, 1:].astype(jnp.bfloat16)
             )
             return loss, accuracy
 
@@ -131,7 +196,7 @@ def create_fsdp_eval_step(partition_spec=PartitionSpec(('dp', 'fsdp'), 'mp')):
                                     return_dict=True).logits
 
             loss, accuracy = cross_entropy_loss_and_accuracy(
-                logits[:, :-1, :], labels, batch_eval['attention_mask'].astype(jnp.float32)[:, 1:]
+                logits[:, :-1, :], labels, batch_eval['attention_mask'][:, 1:].astype(jnp.bfloat16)
             )
             return loss, accuracy
 
@@ -141,20 +206,80 @@ def create_fsdp_eval_step(partition_spec=PartitionSpec(('dp', 'fsdp'), 'mp')):
     return fsdp_eval_step
 
 
-def predict(state, input_ids):
+def _short_repr(value):
+    """
+    The _short_repr function renders a value for the `__str__` of the trainer without touching its contents, plain
+    python values are shown as they are, callables by their name and everything else (pytrees, arrays, datasets, ...)
+    by its type only.
+
+    :param value: The value to render
+    :return: A short string of the value
+
+    """
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return repr(value)
+    if callable(value):
+        return f'<callable {getattr(value, "__name__", type(value).__name__)}>'
+    return f'<{type(value).__name__}>'
+
+
+def _perplexity(loss: float):
+    """
+    The _perplexity function returns exp(loss), and inf instead of raising once a diverging loss overflows it.
+
+    :param loss: float: The cross entropy loss
+    :return: The perplexity
+
     """
-    The predict function takes in a state and input_ids, and returns the next token.
+    try:
+        return math.exp(loss)
+    except OverflowError:
+        return float('inf')
+
+
+def _collate_batch(batch, drop_set: frozenset, max_length: int, is_left_padded: bool):
+    """
+    The _collate_batch function builds a batch on host with numpy, pjit then moves every key to the devices in a
+    single transfer. Every example is cut to max_length before stacking, so examples of different lengths (longer
+    than max_length) still stack, and the keys the model does not take are never collated nor transferred.
+
+    :param batch: The examples of the batch
+    :param drop_set: frozenset: Keys of the examples to leave out
+    :param max_length: int: Maximum length of a sequence
+    :param is_left_padded: bool: Keep the last max_length tokens instead of the first ones
+    :return: A dictionary of stacked numpy arrays
+
+    """
+    rs = {}
+    for key in batch[0].keys() - drop_set:
+        if is_left_padded:
+            arr = np.stack([np.asarray(f[key])[..., -max_length:] for f in batch], axis=0)
+        else:
+            arr = np.stack([np.asarray(f[key])[..., :max_length] for f in batch], axis=0)
+        rs[key] = arr.reshape(-1, arr.shape[-1])
+    return rs
+
+
+def predict(state, input_ids, position):
+    """
+    The predict function takes in a state, a preallocated buffer of input_ids and the position of the next token, and
+    writes the greedy next token into the buffer at that position. The buffer keeps the same shape for the whole
+    decoding, so the function is compiled once and never re-specialized for a longer sequence.
 
     :param state: Store the model parameters and the input_ids parameter is used to pass in a batch of token ids
-    :param input_ids: Pass the input to the model
-    :return: The next input_ids
+    :param input_ids: Pass the `(batch_size, prompt_length + max_new_tokens)` buffer holding the tokens so far
+    :param position: Index in the buffer the next token is written to, the tokens before it are the input
+    :return: The updated input_ids and the position of the token after
 
     """
     input_ids = with_sharding_constraint(input_ids, PartitionSpec(('dp', 'fsdp')))
+    # the model is causal, so the not yet written tail of the buffer does not change the logits before position
     pred = state.apply_fn(params=state.params, input_ids=input_ids, return_dict=True)
-    token = jnp.argmax(jax.nn.softmax(pred.logits)[:, -1, :])
-    input_ids = jnp.concatenate([input_ids, token.reshape(1, -1)], axis=-1)
-    return input_ids
+    last_logits = jax.lax.dynamic_index_in_dim(pred.logits, position - 1, axis=1, keepdims=False)
+    # softmax is monotonic, so the argmax of the last logits already is the greedy token
+    token = jnp.argmax(last_logits, axis=-1)
+    input_ids = jax.lax.dynamic_update_slice(input_ids, token[:, None].astype(input_ids.dtype), (0, position))
+    return input_ids, position + 1
 
 
 @dataclasses.dataclass
@@ -209,9 +334,14 @@ class CausalLMTrainer:
         self.tx = None
         self.sharded_create_from_params_fn = None
         self.sharded_train_step_fn = None
+        self.sharded_eval_step_fn = None
+        self.compiled_train_steps = {}
+        self.compiled_eval_steps = {}
         self.sharded_predict = None
         self.mesh = None
         self.ckpt_streamer = None
+        self._ckpt_executor = None
+        self._pending_metrics = []
         self.init_fn = None
         self.train_state_shape = None
         self.train_state_partition_spec = None
@@ -238,22 +368,7 @@ class CausalLMTrainer:
     def __str__(self):
         string = f'CausalLMTrainer('
         for k, v in self.__dict__.items():
-            if isinstance(v, typing.Callable):
-                def string_func(it_self):
-
-                    string_ = f'{it_self.__class__.__name__}(\n'
-                    for k_, v_ in it_self.__dict__.items():
-                        string_ += f'\t\t{k_} : {v_}\n'
-                    string_ += '\t)'
-                    return string_
-
-                try:
-                    v.__str__ = string_func
-                    v = v.__str__(v)
-                except RuntimeError:
-                    pass
-
-            string += f'\n\t{k} : {v}'
+            string += f'\n\t{k} : {_short_repr(v)}'
         string += ')'
         return string
 
@@ -284,6 +399,7 @@ class CausalLMTrainer:
 
         """
         self.wandb_runtime = self.arguments.get_wandb_init() if self.arguments.use_wandb else None
+        self._ckpt_executor = ThreadPoolExecutor(max_workers=1)
         self.timer = Timers(
             use_wandb=False,
             tensorboard_writer=self.arguments.get_board()
@@ -318,6 +434,7 @@ class CausalLMTrainer:
         self.mesh = funcs[3]
         self.ckpt_streamer = funcs[4]
         self.init_fn = funcs[5]
+        self.sharded_eval_step_fn = funcs[6]
         self.timer(
             'configure functions and sharding them'
         ).stop()
@@ -333,25 +450,39 @@ class CausalLMTrainer:
 
         """
 
-        def collate_fn(batch):
-            rs = {}
-            for key in batch[0].keys():
-                if self.arguments.is_left_padded:
-                    ssp = [jnp.array(f[key])[..., -self.arguments.max_length:] for f in batch]
-                else:
-                    ssp = [jnp.array(f[key])[..., :self.arguments.max_length] for f in batch]
-                rs[key] = jnp.stack(ssp).reshape(-1, ssp[0].shape[-1])
-            return rs
-
-        dataloader_train = DataLoader(self.dataset_train, collate_fn=collate_fn,
-                                      batch_size=self.arguments.total_batch_size, drop_last=True)
-        max_steps_train = self.arguments.num_train_epochs * len(
-            dataloader_train) if self.arguments.max_steps is None else self.arguments.max_steps
+        # labels are sliced from input_ids inside the train and eval steps
+        drop_set = set(self.arguments.ids_to_pop_from_dataset) | {'token_type_ids', 'labels'}
+
+        # a partial of a module level function, so it can be pickled to spawned workers
+        collate_fn = functools.partial(
+            _collate_batch,
+            drop_set=frozenset(drop_set),
+            max_length=self.arguments.max_length,
+            is_left_padded=self.arguments.is_left_padded
+        )
+
+        num_workers = self.arguments.dataloader_num_workers
+        dataloader_kwargs = dict(
+            collate_fn=collate_fn,
+            batch_size=self.arguments.total_batch_size,
+            drop_last=True,
+            num_workers=num_workers,
+            pin_memory=False,
+            persistent_workers=num_workers > 0,
+            prefetch_factor=4 if num_workers > 0 else None,
+            # jax is already running its threads here, forking the process could deadlock the workers
+            multiprocessing_context='spawn' if num_workers > 0 else None
+        )
+        dataloader_train = DataLoader(self.dataset_train, **dataloader_kwargs)
+        # drop_last=True, so the steps per epoch follow from the dataset length alone
+        max_steps_train = self.arguments.num_train_epochs * (
+                len(self.dataset_train) // self.arguments.total_batch_size
+        ) if self.arguments.max_steps is None else self.arguments.max_steps
         if self.dataset_eval is not None and self.arguments.do_eval:
-            dataloader_eval = DataLoader(self.dataset_eval, collate_fn=collate_fn,
-                                         batch_size=self.arguments.total_batch_size, drop_last=True)
+            dataloader_eval = DataLoader(self.dataset_eval, **dataloader_kwargs)
             max_steps_eval = len(
-                dataloader_eval) if self.arguments.max_steps is None else self.arguments.max_steps
+                self.dataset_eval
+            ) // self.arguments.total_batch_size if self.arguments.max_steps is None else self.arguments.max_steps
         else:
             dataloader_eval, max_steps_eval = None, 0
         return dataloader_train, max_steps_train, dataloader_eval, max_steps_eval
@@ -367,7 +498,8 @@ class CausalLMTrainer:
         extra_configs = {} if self.arguments.extra_configs is None else self.arguments.extra_configs
         if self.arguments.model_class is None:
             config = AutoConfig.from_pretrained(self.arguments.model_id, trust_remote_code=True
-                                                , gradient_checkpointing=self.arguments.gradient_checkpointing,
+                                                , gradient_checkpointing=self.arguments.get_gradient_checkpointing(),
+                                                gradient_checkpointing_policy=self.arguments.gradient_checkpointing_policy,
                                                 use_pjit_attention_force=self.arguments.use_pjit_attention_force,
                                                 **extra_configs
                                                 )
@@ -387,6 +519,13 @@ class CausalLMTrainer:
             ].use_pjit_attention_force = self.arguments.use_pjit_attention_force
 
             self.arguments.configs_to_init_model_class['config'].axis_dims = self.arguments.sharding_array
+            self.arguments.configs_to_init_model_class[
+                'config'
+            ].gradient_checkpointing_policy = self.arguments.gradient_checkpointing_policy
+            if self.arguments.gradient_checkpointing_policy in ('none', 'offload'):
+                self.arguments.configs_to_init_model_class[
+                    'config'
+                ].gradient_checkpointing = self.arguments.get_gradient_checkpointing()
 
             model = self.arguments.model_class(
                 **self.arguments.configs_to_init_model_class,
@@ -395,6 +534,13 @@ class CausalLMTrainer:
 
             config = self.arguments.configs_to_init_model_class['config']
 
+        if self.arguments.gradient_checkpointing_policy == 'sqrt' and getattr(config, 'model_type', None) not in (
+                SQRT_REMAT_MODEL_TYPES
+        ):
+            raise ValueError(
+                f"gradient_checkpointing_policy 'sqrt' is only implemented for {', '.join(SQRT_REMAT_MODEL_TYPES)} "
+                f"models, {getattr(config, 'model_type', type(config).__name__)} would silently fall back to 'full'"
+            )
         tx, scheduler = self.arguments.get_optimizer_and_scheduler(self.max_steps_train)
         return model, tx, scheduler, config
 
@@ -411,13 +557,20 @@ class CausalLMTrainer:
         """
 
         def init_fn():
+            # the params are created in param_dtype by the model itself, the compute dtype is applied by the
+            # modules, so param_dtype=jnp.float32 keeps fp32 master weights (and fp32 optimizer moments)
             params__ = self.model.init_weights(
                 jax.random.PRNGKey(0), self.arguments.init_input_shape
             )
-            if self.arguments.dtype == jnp.bfloat16:
-                params__ = self.model.to_bf16(params__)
-            elif self.arguments.dtype == jnp.float16:
-                params__ = self.model.to_fp16(params__)
+            param_dtype = jnp.dtype(self.arguments.param_dtype)
+            # models that do not take param_dtype (gpt-j, opt, t5, custom model classes, ...) create fp32 params,
+            # those are cast here, inside the compiled init
+            params__ = jax.tree_util.tree_map(
+                lambda x: x.astype(param_dtype) if jnp.issubdtype(x.dtype, jnp.floating) and (
+                        x.dtype != param_dtype
+                ) else x,
+                params__
+            )
             return train_state.TrainState.create(
                 tx=self.tx,
                 params=flax.core.freeze({'params': params__}),
@@ -433,21 +586,55 @@ class CausalLMTrainer:
 
         if self.arguments.loss_remat == 'OHA':
             loss_fn = fjformer.func.loss_func.cross_entropy_with_logits
+        elif self.arguments.loss_remat == 'FUSED_LCE':
+            # needs the hidden states and the lm_head kernel instead of logits, see calculate_loss
+            loss_fn = None
         elif self.arguments.loss_remat != '':
             loss_fn = fused_cross_entropy_loss_and_accuracy
         else:
             loss_fn = cross_entropy_loss_and_accuracy
 
+        def last_hidden_states(apply_fn, params, batch):
+            if self.arguments.gradient_checkpointing_policy == 'sqrt':
+                # output_hidden_states would turn the sqrt(L) remat off, the base model returns the (normed) last
+                # hidden states on its own
+                input_ids = batch['input_ids']
+                position_ids = batch.get('position_ids', None)
+                if position_ids is None:
+                    position_ids = jnp.broadcast_to(jnp.arange(input_ids.shape[-1])[None, :], input_ids.shape)
+                return self.model.module.apply(
+                    params,
+                    input_ids.astype('i4'),
+                    batch['attention_mask'].astype('i4'),
+                    position_ids.astype('i4'),
+                    method=lambda module, *args: module.model(*args, return_dict=True).last_hidden_state
+                )
+            return apply_fn(params=params, **batch, return_dict=True,
+                            output_hidden_states=True).hidden_states[-1]
+
         def fsdp_train_step_(state, batch):
             batch = with_sharding_constraint(batch, self.arguments.step_partition_spec)
 
             def calculate_loss(params):
-                labels = batch.pop('labels')
+                # sliced inside the step so XLA fuses it into the loss instead of shipping a second copy
+                labels = batch['input_ids'][:, 1:]
+                if self.arguments.loss_remat == 'FUSED_LCE':
+                    # the logits are never used here, so XLA drops the model's own lm_head matmul
+                    hidden_states = last_hidden_states(state.apply_fn, params, batch)[:, :-1, :]
+                    lm_head = params['params']['lm_head']
+                    return chunked_linear_cross_entropy_loss_and_accuracy(
+                        hidden_states,
+                        lm_head['kernel'],
+                        labels,
+                        batch['attention_mask'][:, 1:],
+                        chunk_size=self.arguments.loss_chunk,
+                        bias=lm_head.get('bias', None)
+                    )
                 logits = state.apply_fn(params=params, **batch,
                                         return_dict=True).logits[:, :-1, :]
 
                 loss, accuracy = loss_fn(
-                    logits, labels, batch['attention_mask'].astype(jnp.float32)[:, 1:]
+                    logits, labels, batch['attention_mask'][:, 1:].astype(jnp.bfloat16)
                 )
                 return loss, accuracy
 
@@ -456,7 +643,26 @@ class CausalLMTrainer:
             state = state.apply_gradients(grads=grad)
             return state, loss__, accuracy__
 
+        def fsdp_eval_step_(state, batch_eval):
+            batch_eval = with_sharding_constraint(batch_eval, self.arguments.step_partition_spec)
+            labels = batch_eval['input_ids'][:, 1:]
+            logits = state.apply_fn(params=state.params, **batch_eval,
+                                    return_dict=True).logits[:, :-1, :]
+
+            loss, accuracy = cross_entropy_loss_and_accuracy(
+                logits, labels, batch_eval['attention_mask'][:, 1:].astype(jnp.bfloat16)
+            )
+            return loss, accuracy
+
         train_state_shape = jax.eval_shape(init_fn)
+        if self.arguments.loss_remat == 'FUSED_LCE' and (
+                getattr(self.config, 'tie_word_embeddings', False)
+                or 'kernel' not in train_state_shape.params['params'].get('lm_head', {})
+        ):
+            raise ValueError(
+                "loss_remat 'FUSED_LCE' needs an untied lm_head kernel, models with tie_word_embeddings project "
+                "with the embedding table and have no lm_head params, use another loss_remat for those"
+            )
         train_state_partition_spec = match_partition_rules(
             self.config.get_partition_rules(
                 fully_fsdp=self.arguments.fully_fsdp
@@ -473,16 +679,110 @@ class CausalLMTrainer:
             fsdp_train_step_,
             in_shardings=(train_state_partition_spec, PartitionSpec()),
             out_shardings=(train_state_partition_spec, PartitionSpec(), PartitionSpec()),
-            donate_argnums=(0, 0),
+            # only the state is donated, the batch has no output of its shape and dtype to be aliased with
+            donate_argnums=(0,),
+        )
+        sharded_eval_step_fn = pjit(
+            fsdp_eval_step_,
+            in_shardings=(train_state_partition_spec, PartitionSpec()),
+            out_shardings=(PartitionSpec(), PartitionSpec()),
         )
-        sharded_predict = pjit(predict, out_shardings=PartitionSpec(),
-                               in_shardings=(train_state_partition_spec, PartitionSpec()))
+        sharded_predict = pjit(predict, out_shardings=(PartitionSpec(), PartitionSpec()),
+                               in_shardings=(train_state_partition_spec, PartitionSpec(), PartitionSpec()),
+                               donate_argnums=(1,))
         mesh = self.arguments.get_mesh()
         self.arguments.ckpt_path_exists()
         ckpt_streamer = self.arguments.get_streaming_checkpointer()
         self.train_state_partition_spec = train_state_partition_spec
         self.train_state_shape = train_state_shape
-        return sharded_create_from_params_fn, sharded_train_step_fn, sharded_predict, mesh, ckpt_streamer, init_fn
+        return (
+            sharded_create_from_params_fn,
+            sharded_train_step_fn,
+            sharded_predict,
+            mesh,
+            ckpt_streamer,
+            init_fn,
+            sharded_eval_step_fn
+        )
+
+    def save_checkpoint_async(self, state, filename, gather_fns):
+        """
+        The save_checkpoint_async function gathers the params of the state to the host and hands the writing of the
+        checkpoint off to a background thread, so the training loop keeps dispatching steps while the file is written.
+        The params are gathered before returning because the next train step donates the buffers of the state.
+
+        :param self: Represent the instance of the class
+        :param state: The sharded train state to save the params of
+        :param filename: Name of the checkpoint file
+        :param gather_fns: The gather functions of the train state
+        :return: A future that is done once the checkpoint is written
+
+        """
+        host_params = jax.tree_util.tree_map(
+            lambda f, x: f(x), gather_fns.params['params'], state.params['params']
+        )
+        return self._ckpt_executor.submit(self.ckpt_streamer.save_checkpoint, host_params, filename)
+
+    def flush_pending_metrics(self, log_executor: ThreadPoolExecutor):
+        """
+        The flush_pending_metrics function brings the metrics of every step since the last flush to the host with a
+        single device_get and hands them off to wandb in a background thread, so neither the sync nor the http
+        round trips happen once per step.
+
+        :param self: Represent the instance of the class
+        :param log_executor: ThreadPoolExecutor: Executor the wandb logging runs in
+        :return: The host metrics of the last step or None if no metrics were pending
+
+        """
+        if not self._pending_metrics:
+            return None
+        with jax.spmd_mode("allow_all"):
+            pending_metrics = jax.device_get(self._pending_metrics)
+            learning_rates = jax.device_get(
+                self.scheduler(jnp.asarray([metrics['step'] for metrics in pending_metrics]))
+            ).tolist()
+        self._pending_metrics = []
+        host_metrics = [
+            {
+                "loss": float(metrics['loss']),
+                "learning_rate": learning_rate,
+                "step": metrics['step'],
+                "step time": metrics['step time'],
+                "perplexity": _perplexity(float(metrics['loss'])),
+                "accuracy": float(metrics['accuracy']),
+                "avg_accuracy": float(metrics['accuracy_sum']) / metrics['accuracy_count'],
+                "mem_res": metrics['mem_res'],
+            } for metrics, learning_rate in zip(pending_metrics, learning_rates)
+        ]
+
+        def log_all(all_metrics):
+            for step_metrics in all_metrics:
+                self.wandb_runtime.log(step_metrics)
+
+        if self.arguments.use_wandb:
+            log_executor.submit(log_all, host_metrics)
+        return host_metrics[-1]
+
+    @staticmethod
+    def get_compiled_step(step_fn, compiled_steps: dict, state, batch: dict):
+        """
+        The get_compiled_step function lowers and compiles a pjit step function ahead of time for the shapes of the
+        given batch and caches the compiled executable, so every later step with the same batch shapes calls the
+        compiled executable directly instead of going through the pjit dispatch and trace cache lookup.
+
+        :param step_fn: The pjit step function to compile
+        :param compiled_steps: dict: Cache of the compiled step functions keyed by batch signature
+        :param state: The sharded train state passed to the step
+        :param batch: dict: The batch passed to the step
+        :return: The compiled step function
+
+        """
+        signature = tuple((k, tuple(v.shape), str(v.dtype)) for k, v in sorted(batch.items()))
+        compiled = compiled_steps.get(signature, None)
+        if compiled is None:
+            compiled = step_fn.lower(state, batch).compile()
+            compiled_steps[signature] = compiled
+        return compiled
 
     def train(self, model_parameters: flax.core.FrozenDict = None) -> OutputFineTuner:
         """
@@ -499,9 +799,10 @@ class CausalLMTrainer:
         """
 
         def count_params(_p):
-            print('\033[1;31mModel Contain : ',
-                  sum(i.size for i in jax.tree_util.tree_flatten(flax.core.unfreeze(_p))[0]) / 1e9,
-                  ' Billion Parameters')
+            # tree_leaves walks the FrozenDict directly, no unfrozen copy of the tree is made
+            n_params = sum(leaf.size for leaf in jax.tree_util.tree_leaves(_p)) / 1e9
+            print('\033[1;31mModel Contain : ', n_params, ' Billion Parameters')
+            return n_params
 
         dir_prefix: str = '/dev/shm'
         if self.arguments.track_memory:
@@ -538,24 +839,25 @@ class CausalLMTrainer:
 
                 sharded_train_state_ = self.sharded_create_from_params_fn(params)
 
-                count_params(sharded_train_state_.params)
+                n_params = count_params(sharded_train_state_.params)
             else:
                 sharded_train_state_ = self.init_fn()
 
-                count_params(sharded_train_state_.params)
+                n_params = count_params(sharded_train_state_.params)
 
             pbar = tqdm(total=self.max_steps_train)
             i = sharded_train_state_.step.tolist()
-            losses = []
-            accuracies = []
+            # running sums instead of lists of every step output, constant work and memory per step
+            loss_sum, loss_count = jnp.zeros(()), 0
+            accuracy_sum, accuracy_count = jnp.zeros(()), 0
             pbar.update(sharded_train_state_.step.tolist())
-            learning_rates = []
+            log_executor = ThreadPoolExecutor(max_workers=1)
+            self._pending_metrics = []
+            ckpt_futures = []
             if self.arguments.use_wandb:
                 self.wandb_runtime.log(
                     {
-                        'model billion parameters': sum(
-                            i.size for i in
-                            jax.tree_util.tree_flatten(flax.core.unfreeze(sharded_train_state_.params))[0]) / 1e9
+                        'model billion parameters': n_params
                     }
                 )
             try:
@@ -563,71 +865,63 @@ class CausalLMTrainer:
                     for batch in self.dataloader_train:
                         i += 1
                         if i < self.max_steps_train:
-
-                            batch['labels'] = batch['input_ids'][..., 1:]
-
-                            for ssb in self.arguments.ids_to_pop_from_dataset:
-                                _ = batch.pop(ssb, None)
                             time_s = time.time()
-                            sharded_train_state_, loss, accuracy = self.sharded_train_step_fn(sharded_train_state_,
-                                                                                              batch
-                                                                                              )
+                            train_step = self.get_compiled_step(
+                                self.sharded_train_step_fn, self.compiled_train_steps, sharded_train_state_, batch
+                            )
+                            sharded_train_state_, loss, accuracy = train_step(sharded_train_state_, batch)
                             ttl_time = time.time() - time_s
-                            losses.append(loss)
-                            learning_rates.append(self.scheduler(i).tolist())
-                            accuracies.append(accuracy)
+                            loss_sum, loss_count = loss_sum + loss, loss_count + 1
+                            accuracy_sum, accuracy_count = accuracy_sum + accuracy, accuracy_count + 1
                             if self.arguments.track_memory:
                                 mem_res = get_mem(dir_prefix=dir_prefix)
                             else:
                                 mem_res = 'Tracking Option is OFF'
+                            # kept on device, brought to the host all at once by flush_pending_metrics
+                            self._pending_metrics.append(
+                                {
+                                    "loss": loss,
+                                    "step": i,
+                                    "step time": ttl_time,
+                                    "accuracy": accuracy,
+                                    "accuracy_sum": accuracy_sum,
+                                    "accuracy_count": accuracy_count,
+                                    "mem_res": mem_res,
+                                }
+                            )
                             pbar.update(1)
 
-                            if self.arguments.use_wandb:
-                                with jax.spmd_mode("allow_all"):
-                                    self.wandb_runtime.log(
-                                        {
-                                            "loss": loss.tolist(),
-                                            "learning_rate": self.scheduler(
-                                                sharded_train_state_.step.tolist()
-                                            ).tolist(),
-                                            "step": sharded_train_state_.step.tolist(),
-                                            "step time": ttl_time,
-                                            "perplexity": jnp.exp(loss).tolist(),
-                                            "accuracy": accuracy.tolist(),
-                                            "avg_accuracy": (sum(accuracies) / len(accuracies)).tolist(),
-                                            "mem_res": mem_res,
-                                        }
-                                    )
+                            if i % self.arguments.log_steps == 0:
+                                # the only device to host sync of the loop, the steps in between are dispatched
+                                # back to back without waiting on the device
+                                last_metrics = self.flush_pending_metrics(log_executor)
+                                pbar.set_postfix(loss=last_metrics['loss'],
+                                                 learning_rate=last_metrics['learning_rate'],
+                                                 step=i,
+                                                 perplexity=last_metrics['perplexity'],
+                                                 accuracy=last_metrics['accuracy'],
+                                                 )
                             if self.arguments.track_memory:
                                 IPython.display.clear_output(True)
                                 pbar.display(mem_res)
-                            pbar.set_postfix(loss=loss,
-                                             learning_rate=self.scheduler(sharded_train_state_.step.tolist()).tolist(),
-                                             step=sharded_train_state_.step.tolist(),
-                                             perplexity=jnp.exp(loss).tolist(),
-                                             accuracy=accuracy,
-                                             )
                         else:
                             break
                         if self.arguments.save_steps is not None and i % self.arguments.save_steps == 0:
-                            filename = f'{self.arguments.model_name}-{sum(losses) / len(losses)}-{i}'
+                            filename = f'{self.arguments.model_name}-{float(jax.device_get(loss_sum / max(loss_count, 1)))}-{i}'
                             print(f'Saving Model to \033[1;30m{filename}\033[1;0m')
-                            self.ckpt_streamer.save_checkpoint(sharded_train_state_.params['params'],
-                                                               filename,
-                                                               gather_fns=gather_fns.params['params'])
+                            ckpt_futures.append(self.save_checkpoint_async(sharded_train_state_, filename, gather_fns))
             except KeyboardInterrupt:
                 print(
                     '\033[1;30m KeyboardInterrupt At training model Will return current state of the model * \033[1;0m')
+            self.flush_pending_metrics(log_executor)
             if self.arguments.do_eval:
                 if self.dataset_eval is not None:
                     pbar_eval = tqdm(total=self.max_steps_eval)
                     for i_eval, batch_eval in enumerate(self.dataloader_eval):
-                        _ = batch_eval.pop('token_type_ids', None)
-                        batch_eval['labels'] = batch_eval['input_ids'][..., 1:]
-                        for i in self.arguments.ids_to_pop_from_dataset:
-                            _ = batch_eval.pop(i, None)
-                        loss_eval, accuracy = create_fsdp_eval_step(self.arguments.step_partition_spec)(
-                            sharded_train_state_, batch_eval)
+                        eval_step = self.get_compiled_step(
+                            self.sharded_eval_step_fn, self.compiled_eval_steps, sharded_train_state_, batch_eval
+                        )
+                        loss_eval, accuracy = eval_step(sharded_train_state_, batch_eval)
                         pbar_eval.update(1)
                         if self.arguments.use_wandb:
                             self.wandb_runtime.log(
@@ -636,13 +930,14 @@ class CausalLMTrainer:
                             )
                         pbar_eval.set_postfix(loss_eval=loss_eval.tolist())
             if self.arguments.save_steps is None and self.arguments.do_last_save:
-                filename = f'{self.arguments.model_name}-{sum(losses) / len(losses)}-{i}'
+                filename = f'{self.arguments.model_name}-{float(jax.device_get(loss_sum / max(loss_count, 1)))}-{i}'
                 print(f'Saving Model to \033[1;30m{filename}\033[1;0m')
-                self.ckpt_streamer.save_checkpoint(sharded_train_state_.params['params'],
-                                                   filename,
-                                                   gather_fns=gather_fns.params['params'])
+                ckpt_futures.append(self.save_checkpoint_async(sharded_train_state_, filename, gather_fns))
             else:
                 filename = 'not_saved | None'
+            log_executor.shutdown(wait=True)
+            for future in ckpt_futures:
+                future.result()
         output = OutputFineTuner(
             last_save_file_name=filename,
             predict_fun=self.sharded_predict,
@@ -1,10 +1,58 @@
-import flax.traverse_util
+import collections
+import contextlib
+import functools
+
 import jax
+import numpy as np
+import torch
 
 from flax.traverse_util import flatten_dict
 from flax.serialization import from_bytes, to_bytes, to_state_dict
+import mmap
 import msgpack
 import os
+import queue
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# a single writer, so background saves land on disk in the order they were requested
+_CKPT_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+# marks the end of the stream in the read_ckpt pipeline
+_PIPELINE_END = object()
+# sidecar keys written next to a tensor (`(*key, _SCALE_KEY)`), read_ckpt folds them back into the tensor
+_SCALE_KEY = '__scale__'
+_DTYPE_KEY = '__dtype__'
+# payload of a tensor left unchanged since an earlier checkpoint, followed by the path of the file holding it
+_REF_PREFIX = b'REF:'
+_HASHES_SUFFIX = '.hashes'
+# the v1 layout has no header, files with a header map name their format in it
+_CKPT_FORMATS = ('v1', 'v2')
+_FP8_DTYPES = (jax.numpy.dtype(jax.numpy.float8_e4m3fn), jax.numpy.dtype(jax.numpy.float8_e5m2))
+_FP8_DTYPES_BY_NAME = {dtype.name: dtype for dtype in _FP8_DTYPES}
+_FLOAT_DTYPE_MAP = {
+    'bf16': jax.numpy.bfloat16,
+    'bfloat16': jax.numpy.bfloat16,
+    'fp16': jax.numpy.float16,
+    'float16': jax.numpy.float16,
+    'fp32': jax.numpy.float32,
+    'float32': jax.numpy.float32,
+    'fp64': jax.numpy.float64,
+    'float64': jax.numpy.float64,
+    'fp8_e4m3': jax.numpy.float8_e4m3fn,
+    'float8_e4m3fn': jax.numpy.float8_e4m3fn,
+    'fp8_e5m2': jax.numpy.float8_e5m2,
+    'float8_e5m2': jax.numpy.float8_e5m2,
+}
+# the float dtypes a checkpoint can be cast from, as numpy dtypes so membership is a hash lookup
+_FLOAT_DTYPES = frozenset(
+    jax.numpy.dtype(dtype) for dtype in (jax.numpy.bfloat16, jax.numpy.float16, jax.numpy.float32, jax.numpy.float64)
+)
 
 
 def get_float_dtype_by_name(dtype):
@@ -12,22 +60,15 @@ def get_float_dtype_by_name(dtype):
     The get_float_dtype_by_name function is a helper function that returns the JAX float dtype
     corresponding to the string name of a floating point type.  This is useful for converting
     between strings and JAX float types, which are used in many places throughout this codebase.
+    Checkpoints can also be saved with 'int8', which is not a float dtype but a per tensor quantization,
+    see quantize_int8.
 
 
     :param dtype: Specify the type of data that is being passed into the function
     :return: The float dtype of the input string
     
     """
-    return {
-        'bf16': jax.numpy.bfloat16,
-        'bfloat16': jax.numpy.bfloat16,
-        'fp16': jax.numpy.float16,
-        'float16': jax.numpy.float16,
-        'fp32': jax.numpy.float32,
-        'float32': jax.numpy.float32,
-        'fp64': jax.numpy.float64,
-        'float64': jax.numpy.float64,
-    }[dtype]
+    return _FLOAT_DTYPE_MAP[dtype]
 
 
 def float_tensor_to_dtype(tensor, dtype):
@@ -43,8 +84,7 @@ def float_tensor_to_dtype(tensor, dtype):
         return tensor
     if isinstance(dtype, str):
         dtype = get_float_dtype_by_name(dtype)
-    float_dtypes = (jax.numpy.bfloat16, jax.numpy.float16, jax.numpy.float32, jax.numpy.float64)
-    if getattr(tensor, 'dtype', None) in float_dtypes:
+    if getattr(tensor, 'dtype', None) in _FLOAT_DTYPES:
         tensor = tensor.astype(dtype)
     return tensor
 
@@ -70,11 +110,71 @@ def match_keywords(string, ts, ns):
     return True
 
 
+def _get_torch_dtype(dtype):
+    """
+    The _get_torch_dtype function returns the torch dtype matching a jax float dtype, so the cast can be done by
+    torch in the same pass as the copy to the host.
+
+    :param dtype: The jax dtype to match
+    :return: The torch dtype or None if torch has no matching dtype
+
+    """
+    return {
+        jax.numpy.dtype(jax.numpy.bfloat16): torch.bfloat16,
+        jax.numpy.dtype(jax.numpy.float16): torch.float16,
+        jax.numpy.dtype(jax.numpy.float32): torch.float32,
+        jax.numpy.dtype(jax.numpy.float64): torch.float64,
+    }.get(jax.numpy.dtype(dtype), None)
+
+
+def _torch_to_numpy(tensor, dtype):
+    """
+    The _torch_to_numpy function turns a host torch tensor into a numpy array of the given dtype, bfloat16 tensors
+    are reinterpreted bit by bit since numpy can not take them from torch directly.
+
+    :param tensor: The torch tensor on the host
+    :param dtype: The dtype of the returned array
+    :return: A numpy array that owns its memory, it never aliases the state dict nor the pinned copy buffers
+
+    """
+    if tensor.dtype == torch.bfloat16:
+        array = tensor.view(torch.int16).numpy().view(jax.numpy.dtype(jax.numpy.bfloat16))
+    else:
+        array = tensor.numpy()
+    return array.astype(dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def _make_key_rewriter(embedding_layer_name: str):
+    """
+    The _make_key_rewriter function returns the function mapping a huggingface parameter name to the key tuple of
+    the easydel params (`.weight` of the embedding becomes `.embedding` and `.weight` of the kernels becomes
+    `.kernel`), with the embedding layer name and the suffix length bound as locals of the closure.
+
+    :param embedding_layer_name: str: Identify the embedding layer in the huggingface model
+    :return: A function returning the key tuple and whether the parameter is a kernel (transposed if it is 2D)
+
+    """
+    suffix_length = len('.weight')
+
+    def rewrite_key(key: str):
+        if embedding_layer_name in key:
+            return tuple((key[:-suffix_length] + '.embedding').split('.')), False
+        if 'kernel' in key and 'none' not in key:
+            if key.endswith('.weight'):
+                key = key[:-suffix_length] + '.kernel'
+            return tuple(key.split('.')), True
+        return tuple(key.split('.')), False
+
+    return rewrite_key
+
+
 def huggingface_to_easydel(
         state_dict,
         embedding_layer_name: str,
         device,
-        dtype: jax.numpy.dtype = jax.numpy.float16
+        dtype: jax.numpy.dtype = jax.numpy.float16,
+        max_pinned_bytes: int = 1 << 30
 ):
     """
     The huggingface_to_easydel function takes a huggingface model's state_dict and converts it to an easydel
@@ -84,35 +184,268 @@ def huggingface_to_easydel(
 
     :param state_dict: Load the weights from a huggingface model
     :param embedding_layer_name: str: Identify the embedding layer in the huggingface model
-    :param device: Determine which device the model will be loaded on
+    :param device: Kept for compatibility, the weights are returned as host numpy arrays
     :param dtype: jax.numpy.dtype: Specify the data type of the tensors
+    :param max_pinned_bytes: int: Bytes of page locked host memory the cuda tensors are staged through at once, a
+        single tensor larger than that is staged on its own
     :return: A dictionary of the weights and biases in a format that can be used by flax (it's an UnFlattenDict)
     
     """
-    _l = len('.weight')
-    with jax.default_device(device):
-        flax_dict = {}
-        for key, tensor in state_dict.items():
-            if embedding_layer_name in key:
-                # tensor = tensor.transpose(0, 1)
-                key = key[:-_l] + '.embedding'
-            elif match_keywords(key, ['kernel'], ['none']):
-                if len(tensor.shape) == 2:
-                    tensor = tensor.transpose(0, 1)
-                if key.endswith('.weight'):
-                    key = key[:-_l] + '.kernel'
-            key_tuple = key.split('.')
-            key_names = ()
-            tensor = tensor.detach().cpu().numpy()
-            for k in key_tuple:
-                key_names += k,
-            flax_dict[key_names] = tensor.astype(dtype)
-        return flax.traverse_util.unflatten_dict(flax_dict)
+    torch_dtype = _get_torch_dtype(dtype)
+    rewrite_key = _make_key_rewriter(embedding_layer_name)
+    # the numpy dtype behind the jax one (ml_dtypes' bfloat16 for bfloat16), every cast below stays in numpy
+    np_dtype = jax.numpy.dtype(dtype)
+    # the copies to the host (with the cast fused in) are issued on a side stream in windows of max_pinned_bytes and
+    # waited on once per window, instead of syncing the device for every single tensor
+    copy_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+    def convert(item):
+        key_names_, transpose_, tensor_ = item
+        # the casts of the host tensors run here, in parallel, torch and numpy release the gil while copying
+        if torch_dtype is not None:
+            tensor_ = tensor_.to(dtype=torch_dtype)
+        tensor_ = _torch_to_numpy(tensor_, np_dtype)
+        return key_names_, tensor_.T if transpose_ else tensor_
+
+    flax_dict = {}
+    window = collections.deque()
+    window_bytes = 0
+
+    def flush_window(executor):
+        if copy_stream is not None:
+            copy_stream.synchronize()
+        # popped off the window, so each pinned buffer is dropped as soon as its owned numpy copy is made and the
+        # caching host allocator hands it to the next window
+        futures = [executor.submit(convert, window.popleft()) for _ in range(len(window))]
+        # the nested dict is built while the results come in instead of unflattening it in a second pass
+        for future in futures:
+            key_names, tensor = future.result()
+            node = flax_dict
+            for k in key_names[:-1]:
+                child = node.get(k)
+                if child is None:
+                    child = node[k] = {}
+                node = child
+            node[key_names[-1]] = tensor
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        with torch.cuda.stream(copy_stream) if copy_stream is not None else contextlib.nullcontext():
+            if copy_stream is not None:
+                copy_stream.wait_stream(torch.cuda.default_stream())
+            # bound once, the loop runs for every parameter of the model
+            torch_empty, append = torch.empty, window.append
+            for key, tensor in state_dict.items():
+                key_names, is_kernel = rewrite_key(key)
+                transpose = is_kernel and tensor.dim() == 2
+                tensor = tensor.detach()
+                if tensor.is_cuda:
+                    pinned_dtype = torch_dtype if torch_dtype is not None else tensor.dtype
+                    nbytes = tensor.numel() * torch_empty((), dtype=pinned_dtype).element_size()
+                    if window and window_bytes + nbytes > max_pinned_bytes:
+                        flush_window(executor)
+                        window_bytes = 0
+                    # copies into page locked memory run asynchronously and at full pcie bandwidth, the buffer is
+                    # only a staging area, convert makes the owned numpy copy that is returned
+                    pinned = torch_empty(tensor.shape, dtype=pinned_dtype, pin_memory=True)
+                    pinned.copy_(tensor, non_blocking=True)
+                    tensor = pinned
+                    window_bytes += nbytes
+                append((key_names, transpose, tensor))
+            flush_window(executor)
+    return flax_dict
+
+
+def _put_until_stopped(q: queue.Queue, item, stop: threading.Event):
+    """
+    The _put_until_stopped function puts an item on a bounded queue, giving up once stop is set so a pipeline stage
+    never blocks forever on a consumer that is gone.
+
+    :param q: queue.Queue: The queue to put the item on
+    :param item: The item to put
+    :param stop: threading.Event: Set once the consumer stopped reading
+    :return: True if the item was put on the queue
+
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+# msgpack bin (and old raw str) header byte -> size of the length field that follows it
+_PAYLOAD_LENGTH_SIZES = {0xc4: 1, 0xc5: 2, 0xc6: 4, 0xd9: 1, 0xda: 2, 0xdb: 4}
+
+
+def _unpack_at(view: memoryview, pos: int):
+    """
+    The _unpack_at function decodes the msgpack object starting at pos, the view is fed to the unpacker in growing
+    windows so only about the size of the object is copied, whatever the size of the file.
+
+    :param view: memoryview: The mapped checkpoint file
+    :param pos: int: Offset of the object in the file
+    :return: The object and the offset right after it
+
+    """
+    unpacker = msgpack.Unpacker(use_list=False, strict_map_key=False, max_buffer_size=0)
+    end, window = pos, 65536
+    while True:
+        unpacker.feed(view[end:end + window])
+        end += window
+        try:
+            return unpacker.unpack(), pos + unpacker.tell()
+        except msgpack.OutOfData:
+            if end >= len(view):
+                raise ValueError(f'the checkpoint is truncated, the object at byte {pos} does not end')
+            window *= 2
+
+
+def _iter_ckpt_file(path):
+    """
+    The _iter_ckpt_file function memory maps a checkpoint file and yields its (key, payload) messages, the payloads
+    are memoryviews into the mapped file, so they are never copied out of the page cache before being deserialized.
+
+    Files saved with small_tensor_size start with a `{'format': 'v2', 'small_count': n}` header followed by one
+    message holding the n small tensors, these are yielded first.
+
+    :param path: Specify the path to the checkpoint file
+    :return: A generator of (key, payload) pairs
+
+    """
+    with open(path, 'rb') as stream:
+        size = os.fstat(stream.fileno()).st_size
+        if size == 0:
+            return
+        # the map outlives the file descriptor, it is released once the last payload view is gone
+        mm = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mm, 'madvise'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    view = memoryview(mm)
+    pos = 0
+    if view[0] & 0xf0 == 0x80:
+        header, pos = _unpack_at(view, 0)
+        if header.get('format') not in _CKPT_FORMATS or not isinstance(header.get('small_count'), int):
+            raise ValueError(
+                f'{path} is a checkpoint of format {header.get("format")!r}, which this version of EasyDel can not '
+                f'read (it reads the {", ".join(_CKPT_FORMATS)} formats)'
+            )
+        if header['small_count']:
+            if pos >= size or view[pos] != 0x92:
+                raise ValueError(f'{path} is not a checkpoint, expected the small tensors at byte {pos}')
+            small_keys, pos = _unpack_at(view, pos + 1)
+            small_payloads, pos = _unpack_at(view, pos)
+            if len(small_keys) != header['small_count'] or len(small_payloads) != header['small_count']:
+                raise ValueError(f'{path} is corrupted, its small tensors do not match its header')
+            yield from zip(small_keys, small_payloads)
+    while pos < size:
+        if view[pos] != 0x92:
+            raise ValueError(f'{path} is not a checkpoint, expected a (key, value) message at byte {pos}')
+        key, pos = _unpack_at(view, pos + 1)
+        if pos >= size:
+            raise ValueError(f'{path} is truncated, the value of {key} is missing')
+        header = view[pos]
+        if 0xa0 <= header <= 0xbf:
+            length, pos = header & 0x1f, pos + 1
+        elif header in _PAYLOAD_LENGTH_SIZES:
+            length_size = _PAYLOAD_LENGTH_SIZES[header]
+            length = int.from_bytes(view[pos + 1:pos + 1 + length_size], 'big')
+            pos += 1 + length_size
+        else:
+            raise ValueError(f'{path} is not a checkpoint, expected a bytes value at byte {pos}')
+        if pos + length > size:
+            raise ValueError(f'{path} is truncated, the value of {key} ends past the end of the file')
+        yield key, view[pos:pos + length]
+        pos += length
+
+
+def _resolve_refs(path, messages, referencing: tuple = ()):
+    """
+    The _resolve_refs function replaces the payloads of the incremental checkpoints that refer to an earlier
+    checkpoint (`REF:<path>`) with the payload stored there, every referenced file is mapped once.
+
+    :param path: Specify the path to the checkpoint file the messages come from
+    :param messages: An iterable of (key, payload) pairs
+    :param referencing: tuple: Real paths of the checkpoints whose references led to this one
+    :return: A generator of (key, payload) pairs
+
+    """
+    referenced = {}
+    directory = os.path.dirname(os.path.abspath(path))
+    referencing = referencing + (os.path.realpath(path),)
+    for key, value in messages:
+        # a plain payload is a single msgpack object, it never starts with the ascii of the prefix
+        if value[:len(_REF_PREFIX)] == _REF_PREFIX:
+            ref_path = os.path.normpath(os.path.join(directory, bytes(value[len(_REF_PREFIX):]).decode()))
+            if ref_path not in referenced:
+                if os.path.realpath(ref_path) in referencing:
+                    raise ValueError(
+                        f'{path} refers to {ref_path}, which refers back to it, the checkpoints form a cycle'
+                    )
+                referenced[ref_path] = dict(_resolve_refs(ref_path, _iter_ckpt_file(ref_path), referencing))
+            if key not in referenced[ref_path]:
+                raise ValueError(f'{path} refers to {ref_path} for {key}, which is not in it')
+            value = referenced[ref_path][key]
+        yield key, value
+
+
+def _unpack_stage(path, out_queue: queue.Queue, stop: threading.Event):
+    """
+    The _unpack_stage function is the first stage of the read_ckpt pipeline, it reads the msgpack messages of the
+    checkpoint file and puts the (key, payload) pairs on out_queue.
+
+    :param path: Specify the path to the checkpoint file
+    :param out_queue: queue.Queue: Queue of the decode stage
+    :param stop: threading.Event: Set once the reader of the pipeline stopped
+    :return: Nothing
+
+    """
+    try:
+        for key, value in _resolve_refs(path, _iter_ckpt_file(path)):
+            if not _put_until_stopped(out_queue, (key, value), stop):
+                return
+    except BaseException as e:
+        _put_until_stopped(out_queue, e, stop)
+    else:
+        _put_until_stopped(out_queue, _PIPELINE_END, stop)
+
+
+def _decode_stage(in_queue: queue.Queue, out_queue: queue.Queue, stop: threading.Event):
+    """
+    The _decode_stage function is the second stage of the read_ckpt pipeline, it deserializes the payloads coming
+    from the unpack stage into tensors and puts the (key, tensor) pairs on out_queue.
+
+    :param in_queue: queue.Queue: Queue of the unpack stage
+    :param out_queue: queue.Queue: Queue read by read_ckpt
+    :param stop: threading.Event: Set once the reader of the pipeline stopped
+    :return: Nothing
+
+    """
+    while not stop.is_set():
+        try:
+            item = in_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _PIPELINE_END or isinstance(item, BaseException):
+            _put_until_stopped(out_queue, item, stop)
+            return
+        key, value = item
+        try:
+            item = key, from_bytes(None, value)
+        except BaseException as e:
+            _put_until_stopped(out_queue, e, stop)
+            return
+        if not _put_until_stopped(out_queue, item, stop):
+            return
 
 
 def read_ckpt(path: [str, os.PathLike], shard_fns=None, add_extra_past_fix: list = None):
     """
-    The read_ckpt function reads a checkpoint file and returns the tensors in it.
+    The read_ckpt function reads a checkpoint file and returns the tensors in it. Reading the file, deserializing
+    the tensors and sharding them onto the devices run as a pipeline, a reader thread and a decoder thread feed the
+    calling thread through small bounded queues. int8 and float8 checkpoints are returned as float32 and float8
+    tensors, their sidecar keys are consumed here.
 
     :param path: [str: Specify the path to the checkpoint file
     :param os.PathLike]: Specify the path to the checkpoint file
@@ -121,21 +454,404 @@ def read_ckpt(path: [str, os.PathLike], shard_fns=None, add_extra_past_fix: list
     :return: A dictionary of tensors
     
     """
+    prefix = tuple(add_extra_past_fix) if add_extra_past_fix is not None else None
+    raw_queue = queue.Queue(maxsize=4)
+    tensor_queue = queue.Queue(maxsize=4)
+    stop = threading.Event()
+    stages = [
+        threading.Thread(target=_unpack_stage, args=(path, raw_queue, stop), daemon=True),
+        threading.Thread(target=_decode_stage, args=(raw_queue, tensor_queue, stop), daemon=True),
+    ]
+    for stage in stages:
+        stage.start()
     tensors = {}
-    with open(path, 'rb') as stream:
-        unpacker = msgpack.Unpacker(stream, read_size=83886080, max_buffer_size=0)
-        for key, value in unpacker:
-            if add_extra_past_fix is not None:
-                key = add_extra_past_fix + key
-            key = tuple(key)
-            tensor = from_bytes(None, value)
+    sidecars = {}
+    try:
+        while True:
+            item = tensor_queue.get()
+            if item is _PIPELINE_END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            key, tensor = item
+            if prefix is not None:
+                key = prefix + key
+            if key[-1] in (_SCALE_KEY, _DTYPE_KEY):
+                # always written before the tensor they belong to
+                sidecars[key] = tensor
+                continue
+            scale = sidecars.pop(key + (_SCALE_KEY,), None)
+            if scale is not None:
+                tensor = tensor.astype(scale.dtype) * scale
+            stored_dtype = sidecars.pop(key + (_DTYPE_KEY,), None)
+            if stored_dtype is not None:
+                tensor = tensor.view(_FP8_DTYPES_BY_NAME[stored_dtype])
             if shard_fns is not None:
                 tensor = shard_fns[key](tensor)
             tensors[key] = tensor
+    finally:
+        stop.set()
+        for stage in stages:
+            stage.join()
     return tensors
 
 
-def save_ckpt(train_state, path, gather_fns=None, float_dtype=None):
+def _pack_bin_header(size: int):
+    """
+    The _pack_bin_header function returns the msgpack `bin` header of a payload of the given size, so the payload
+    itself can be written to the file as it is instead of being copied into the packer buffer first.
+
+    :param size: int: Size of the payload in bytes
+    :return: The header bytes
+
+    """
+    if size < 1 << 8:
+        return struct.pack('>BB', 0xc4, size)
+    if size < 1 << 16:
+        return struct.pack('>BH', 0xc5, size)
+    return struct.pack('>BI', 0xc6, size)
+
+
+@functools.partial(jax.jit, static_argnums=1)
+def _cast_array(x, dtype):
+    """
+    The _cast_array function casts a device array to dtype, float8 arrays are returned as their uint8 bits, since
+    flax can not restore float8 arrays from the dtype name it serializes. It is called for one tensor at a time, right
+    before that tensor is gathered, so only a single cast copy is alive on the devices next to the state.
+
+    :param x: The float array
+    :param dtype: The dtype to cast to
+    :return: The cast array
+
+    """
+    x = x.astype(dtype)
+    return jax.lax.bitcast_convert_type(x, jax.numpy.uint8) if dtype in _FP8_DTYPES else x
+
+
+def _int8_scale(tensor):
+    """
+    The _int8_scale function returns the float32 scale quantize_int8 uses for a tensor, absmax / 127.
+
+    :param tensor: The float tensor (numpy or jax array)
+    :return: The float32 scale
+
+    """
+    xp = jax.numpy if isinstance(tensor, jax.Array) else np
+    absmax = xp.max(xp.abs(tensor.astype(xp.float32))) if tensor.size else xp.float32(0)
+    return xp.maximum(absmax / 127, np.finfo(np.float32).tiny).astype(xp.float32)
+
+
+def _int8_apply_scale(tensor, scale):
+    """
+    The _int8_apply_scale function quantizes a float tensor to int8 with the given scale.
+
+    :param tensor: The float tensor (numpy or jax array)
+    :param scale: The scale from _int8_scale
+    :return: The int8 tensor
+
+    """
+    xp = jax.numpy if isinstance(tensor, jax.Array) else np
+    return xp.round(tensor.astype(xp.float32) / scale).astype(xp.int8)
+
+
+def quantize_int8(tensor):
+    """
+    The quantize_int8 function quantizes a float tensor to int8 with a single per tensor scale, the tensor is
+    recovered as `quantized.astype(jnp.float32) * scale`.
+
+    :param tensor: The float tensor (numpy or jax array) to quantize
+    :return: A tuple of the int8 tensor and the float32 scale
+
+    """
+    scale = _int8_scale(tensor)
+    return _int8_apply_scale(tensor, scale), scale
+
+
+_int8_scale_device = jax.jit(_int8_scale)
+_int8_apply_scale_device = jax.jit(_int8_apply_scale)
+
+
+def _quantize_float_tensors_int8(flatten_train_state: dict):
+    """
+    The _quantize_float_tensors_int8 function quantizes the float tensors of a flattened train state with
+    quantize_int8, every quantized tensor is preceded by its scale under the `(*key, '__scale__')` key. Only the
+    scales of the device tensors are computed here (a scalar each), the tensors themselves are quantized one at a
+    time by _iter_ckpt_messages, right before they are gathered.
+
+    :param flatten_train_state: dict: The flattened train state
+    :return: The flattened train state with the scales, and a dictionary of the quantizations left to run per key
+
+    """
+    quantized_state = {}
+    casts = {}
+    for key, value in flatten_train_state.items():
+        if getattr(value, 'dtype', None) in _FLOAT_DTYPES:
+            if isinstance(value, jax.Array):
+                scale = _int8_scale_device(value)
+                casts[key] = functools.partial(_int8_apply_scale_device, scale=scale)
+            else:
+                value, scale = quantize_int8(value)
+            quantized_state[key + (_SCALE_KEY,)] = np.asarray(jax.device_get(scale))
+        quantized_state[key] = value
+    return quantized_state, casts
+
+
+def _cast_float_tensors(flatten_train_state: dict, float_dtype):
+    """
+    The _cast_float_tensors function casts the float tensors of a flattened train state to float_dtype. The host
+    arrays are cast right away with float_tensor_to_dtype, the device arrays are only paired with their cast, which
+    _iter_ckpt_messages runs one tensor at a time, so the cast state is never alive on the devices as a whole.
+
+    :param flatten_train_state: dict: The flattened train state
+    :param float_dtype: The dtype (or its name) to cast the float tensors to, 'int8' quantizes them instead
+    :return: The flattened train state with its sidecars, and a dictionary of the casts left to run per key
+
+    """
+    if float_dtype is None or float_dtype == '':
+        return flatten_train_state, {}
+    if float_dtype == 'int8':
+        return _quantize_float_tensors_int8(flatten_train_state)
+    if isinstance(float_dtype, str):
+        float_dtype = get_float_dtype_by_name(float_dtype)
+    float_dtype = jax.numpy.dtype(float_dtype)
+    as_bits = float_dtype in _FP8_DTYPES
+    cast = functools.partial(_cast_array, dtype=float_dtype)
+    cast_state = {}
+    casts = {}
+    for key, value in flatten_train_state.items():
+        is_float = getattr(value, 'dtype', None) in _FLOAT_DTYPES
+        if as_bits and is_float:
+            # float8 tensors are stored by their bits, the dtype to view them with is kept next to them
+            cast_state[key + (_DTYPE_KEY,)] = float_dtype.name
+        if isinstance(value, jax.Array):
+            if is_float and (as_bits or value.dtype != float_dtype):
+                casts[key] = cast
+        elif as_bits and is_float:
+            value = float_tensor_to_dtype(value, float_dtype).view(np.uint8)
+        else:
+            value = float_tensor_to_dtype(value, float_dtype)
+        cast_state[key] = value
+    return cast_state, casts
+
+
+def _iter_ckpt_messages(
+        flatten_train_state: dict,
+        gather_fns: dict = None,
+        encode_workers: int = None,
+        casts: dict = None
+):
+    """
+    The _iter_ckpt_messages function yields the key and the serialized bytes of every tensor of a flattened train
+    state, cast and gathered to the host. The tensors are cast and gathered one by one in order on the calling
+    thread, and serialized by encode_workers threads, at most encode_workers tensors ahead of the one being written.
+
+    :param flatten_train_state: dict: The flattened train state
+    :param gather_fns: dict: The flattened gather functions
+    :param encode_workers: int: Number of threads serializing the tensors, None for min(8, cpu_count)
+    :param casts: dict: Casts to run on the device tensors before gathering them, by key
+    :return: A generator of (key, payload) pairs
+
+    """
+    if encode_workers is None:
+        encode_workers = min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=encode_workers) as executor:
+        pending = collections.deque()
+        for key, value in flatten_train_state.items():
+            cast = casts.get(key) if casts is not None else None
+            if cast is not None:
+                value = cast(value)
+            # the scale and dtype sidecars have no gather function, they are host values already, every other key
+            # must have one, a tensor left ungathered would be saved as the shard of this host only
+            if gather_fns is not None and key[-1] not in (_SCALE_KEY, _DTYPE_KEY):
+                # gathers can be collectives across hosts, they stay in order on this thread
+                value = gather_fns[key](value)
+            pending.append((key, executor.submit(to_bytes, value)))
+            if len(pending) > encode_workers:
+                key, payload = pending.popleft()
+                yield key, payload.result()
+        while pending:
+            key, payload = pending.popleft()
+            yield key, payload.result()
+
+
+def _prepare_ckpt_messages(
+        train_state,
+        gather_fns=None,
+        float_dtype=None,
+        small_tensor_size: int = None,
+        gather_fns_flat: dict = None,
+        encode_workers: int = None
+):
+    """
+    The _prepare_ckpt_messages function flattens and casts the train state and orders its tensors for writing,
+    with small_tensor_size the tensors below that many bytes come first, to be packed in a single message.
+
+    :param train_state: Store the current state of the training process
+    :param gather_fns: Specify a function that will be used to convert the tensor to bytes
+    :param float_dtype: Convert the tensor to a specific dtype
+    :param small_tensor_size: int: Size in bytes under which tensors are packed together, None to not pack them
+    :param gather_fns_flat: dict: The gather functions already flattened, used instead of gather_fns
+    :param encode_workers: int: Number of threads serializing the tensors, None for min(8, cpu_count)
+    :return: The number of small tensors and a generator of (key, payload) pairs
+
+    """
+    flatten_train_state, casts = _cast_float_tensors(flatten_dict(to_state_dict(train_state)), float_dtype)
+    if gather_fns_flat is not None:
+        gather_fns = gather_fns_flat
+    elif gather_fns is not None:
+        gather_fns = flatten_dict(to_state_dict(gather_fns))
+    small_count = 0
+    if small_tensor_size is not None:
+        # sizes (before the cast) are known before anything is gathered, so the large tensors can still be streamed
+        # one by one
+        smalls = {
+            key: value for key, value in flatten_train_state.items()
+            if getattr(value, 'nbytes', 0) < small_tensor_size
+        }
+        small_count = len(smalls)
+        smalls.update((key, value) for key, value in flatten_train_state.items() if key not in smalls)
+        flatten_train_state = smalls
+    return small_count, _iter_ckpt_messages(flatten_train_state, gather_fns, encode_workers, casts)
+
+
+def _read_hashes(path):
+    """
+    The _read_hashes function reads the hashes sidecar of a checkpoint saved with hash_tensors.
+
+    :param path: Specify the path to the checkpoint file
+    :return: A dictionary mapping every key to the hash of its payload and the file the payload is stored in
+
+    """
+    with open(os.fspath(path) + _HASHES_SUFFIX, 'rb') as stream:
+        entries = msgpack.unpackb(stream.read(), use_list=False, strict_map_key=False)
+    directory = os.path.dirname(os.path.abspath(path))
+    return {key: (digest, os.path.normpath(os.path.join(directory, origin))) for key, digest, origin in entries}
+
+
+def _write_hashes(path, hashes: dict):
+    """
+    The _write_hashes function writes the hashes sidecar of a checkpoint, the files holding the payloads are stored
+    relative to the checkpoint so a directory of checkpoints can be moved around.
+
+    :param path: Specify the path to the checkpoint file
+    :param hashes: dict: Maps every key to the hash of its payload and the file the payload is stored in
+    :return: Nothing
+
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    entries = [(key, digest, os.path.relpath(origin, directory)) for key, (digest, origin) in hashes.items()]
+    with open(os.fspath(path) + _HASHES_SUFFIX, 'wb') as stream:
+        stream.write(msgpack.packb(entries))
+
+
+def _dedupe_messages(messages, path, incremental_base=None):
+    """
+    The _dedupe_messages function hashes the payloads of a checkpoint with xxhash, and replaces the ones that did not
+    change since the incremental_base checkpoint with a reference to the file they are stored in.
+
+    :param messages: An iterable of (key, payload) pairs
+    :param path: Specify the path to the checkpoint file being written
+    :param incremental_base: Path of an earlier checkpoint saved with hash_tensors, None to only hash the payloads
+    :return: A generator of (key, payload) pairs and the dictionary its hashes are recorded in, filled as it runs
+
+    """
+    if xxhash is None:
+        raise ImportError('hashing the checkpoint tensors requires xxhash, install it with `pip install xxhash`')
+    if incremental_base is not None and os.path.realpath(incremental_base) == os.path.realpath(path):
+        raise ValueError(f'an incremental checkpoint can not overwrite its base {incremental_base}')
+    base_hashes = _read_hashes(incremental_base) if incremental_base is not None else {}
+    directory = os.path.dirname(os.path.abspath(path))
+    origin = os.path.abspath(path)
+    real_origin = os.path.realpath(path)
+    hashes = {}
+
+    def dedupe():
+        for key, payload in messages:
+            digest = xxhash.xxh64_intdigest(payload)
+            base = base_hashes.get(key)
+            # a payload held by the file being overwritten is written again instead of referred to
+            if base is not None and base[0] == digest and os.path.realpath(base[1]) != real_origin:
+                # refer to the file actually holding the payload, so references never chain
+                hashes[key] = base
+                payload = _REF_PREFIX + os.path.relpath(base[1], directory).encode()
+            else:
+                hashes[key] = digest, origin
+            yield key, payload
+
+    return dedupe(), hashes
+
+
+def _write_ckpt(
+        messages,
+        path,
+        sync_to_disk: bool = False,
+        small_count: int = 0,
+        hashes: dict = None
+):
+    """
+    The _write_ckpt function writes (key, payload) pairs to a checkpoint file, one msgpack message per tensor. The
+    first small_count pairs are written together as one message after a `{'format': 'v2'}` header.
+
+    :param messages: An iterable of (key, payload) pairs
+    :param path: Specify the location of the checkpoint file
+    :param sync_to_disk: bool: Flush the file down to the disk before returning
+    :param small_count: int: Number of leading pairs to pack in a single message
+    :param hashes: dict: Hashes of the payloads, written to the hashes sidecar once the checkpoint is written
+    :return: Nothing
+
+    """
+    # one packer buffer reused for the small (key) part of every message
+    packer = msgpack.Packer(autoreset=False)
+    with open(path, "wb", buffering=64 * 1024 * 1024) as stream:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(stream.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if isinstance(messages, list) and hasattr(os, 'posix_fallocate'):
+            # the payloads alone are a lower bound of the file size, so the file never ends in preallocated zeros
+            payload_size = sum(len(payload) for _, payload in messages)
+            if payload_size:
+                try:
+                    os.posix_fallocate(stream.fileno(), 0, payload_size)
+                except OSError:
+                    pass
+        messages = iter(messages)
+        if small_count:
+            smalls = [next(messages) for _ in range(small_count)]
+            packer.pack({'format': 'v2', 'small_count': small_count})
+            packer.pack(([key for key, _ in smalls], [payload for _, payload in smalls]))
+            stream.write(packer.bytes())
+            packer.reset()
+        # bound once, the loop runs for every tensor of the state
+        pack_array_header, pack, packed, reset, write = (
+            packer.pack_array_header, packer.pack, packer.bytes, packer.reset, stream.write
+        )
+        pack_bin_header = _pack_bin_header
+        for key, payload in messages:
+            # byte for byte the same message as packer.pack((key, payload)), without copying the payload around
+            pack_array_header(2)
+            pack(key)
+            write(packed())
+            reset()
+            write(pack_bin_header(len(payload)))
+            write(payload)
+        if sync_to_disk:
+            stream.flush()
+            getattr(os, 'fdatasync', os.fsync)(stream.fileno())
+    if hashes is not None:
+        # only once the checkpoint is complete, a later incremental save never refers to a partial file
+        _write_hashes(path, hashes)
+
+
+def save_ckpt(
+        train_state,
+        path,
+        gather_fns=None,
+        float_dtype=None,
+        small_tensor_size: int = None,
+        hash_tensors: bool = False,
+        incremental_base=None,
+        gather_fns_flat: dict = None,
+        encode_workers: int = None
+):
     """
     The save_ckpt function saves the state of a training run to disk.
 
@@ -143,19 +859,66 @@ def save_ckpt(train_state, path, gather_fns=None, float_dtype=None):
     :param path: Specify the location of the checkpoint file
     :param gather_fns: Specify a function that will be used to convert the tensor to bytes
     :param float_dtype: Convert the tensor to a specific dtype
+    :param small_tensor_size: int: Pack the tensors smaller than this many bytes in a single message (v2 layout,
+    read by read_ckpt only), None keeps one message per tensor
+    :param hash_tensors: bool: Write the xxhash of every tensor to a `.hashes` sidecar, so the next checkpoints can
+    be saved incrementally against this one
+    :param incremental_base: Path of an earlier checkpoint saved with hash_tensors, the tensors that did not change
+    since are written as references to it (only read_ckpt follows them), implies hash_tensors
+    :param gather_fns_flat: dict: gather_fns already flattened (`flatten_dict(to_state_dict(gather_fns))`), used
+    instead of gather_fns, callers saving often can flatten them once and skip it on every save
+    :param encode_workers: int: Number of threads serializing the tensors while the file is written, None for
+    min(8, cpu_count)
     :return: Nothing
     
     """
+    small_count, messages = _prepare_ckpt_messages(
+        train_state, gather_fns, float_dtype, small_tensor_size, gather_fns_flat, encode_workers
+    )
+    hashes = None
+    if hash_tensors or incremental_base is not None:
+        messages, hashes = _dedupe_messages(messages, path, incremental_base)
+    _write_ckpt(messages, path, small_count=small_count, hashes=hashes)
 
-    train_state = to_state_dict(train_state)
-    packer = msgpack.Packer()
-    flatten_train_state = flatten_dict(train_state)
-    if gather_fns is not None:
-        gather_fns = flatten_dict(to_state_dict(gather_fns))
 
-    with open(path, "wb") as stream:
-        for key, value in flatten_train_state.items():
-            if gather_fns is not None:
-                value = gather_fns[key](value)
-            value = float_tensor_to_dtype(value, float_dtype)
-            stream.write(packer.pack((key, to_bytes(value))))
+def save_ckpt_async(
+        train_state,
+        path,
+        gather_fns=None,
+        float_dtype=None,
+        small_tensor_size: int = None,
+        hash_tensors: bool = False,
+        incremental_base=None,
+        gather_fns_flat: dict = None,
+        encode_workers: int = None
+):
+    """
+    The save_ckpt_async function saves the state of a training run to disk in the background. The tensors are
+    gathered, cast and serialized to host bytes before returning, so the train state can be updated (or donated)
+    right away, and only the writing of the file is left to a background thread.
+
+    :param train_state: Store the current state of the training process
+    :param path: Specify the location of the checkpoint file
+    :param gather_fns: Specify a function that will be used to convert the tensor to bytes
+    :param float_dtype: Convert the tensor to a specific dtype
+    :param small_tensor_size: int: Pack the tensors smaller than this many bytes in a single message (v2 layout,
+    read by read_ckpt only), None keeps one message per tensor
+    :param hash_tensors: bool: Write the xxhash of every tensor to a `.hashes` sidecar, so the next checkpoints can
+    be saved incrementally against this one
+    :param incremental_base: Path of an earlier checkpoint saved with hash_tensors, the tensors that did not change
+    since are written as references to it (only read_ckpt follows them), implies hash_tensors. With a background
+    save in flight, the base must be a checkpoint whose future is done
+    :param gather_fns_flat: dict: gather_fns already flattened (`flatten_dict(to_state_dict(gather_fns))`), used
+    instead of gather_fns, callers saving often can flatten them once and skip it on every save
+    :param encode_workers: int: Number of threads serializing the tensors while the file is written, None for
+    min(8, cpu_count)
+    :return: A concurrent.futures.Future that is done once the file is written and synced to disk
+
+    """
+    small_count, messages = _prepare_ckpt_messages(
+        train_state, gather_fns, float_dtype, small_tensor_size, gather_fns_flat, encode_workers
+    )
+    hashes = None
+    if hash_tensors or incremental_base is not None:
+        messages, hashes = _dedupe_messages(messages, path, incremental_base)
+    return _CKPT_EXECUTOR.submit(_write_ckpt, list(messages), path, True, small_count, hashes)
@@ -0,0 +1,223 @@
+import os
+import tempfile
+import unittest
+
+import msgpack
+import numpy as np
+
+try:
+    from lib.python.EasyDel.transform.easydel_transform import read_ckpt, save_ckpt, _write_ckpt, _iter_ckpt_file, \
+        _REF_PREFIX
+except ModuleNotFoundError:
+    import sys
+    from pathlib import Path
+
+    cp = Path.cwd().__str__()
+    sys.path.append(cp)
+    from lib.python.EasyDel.transform.easydel_transform import read_ckpt, save_ckpt, _write_ckpt, _iter_ckpt_file, \
+        _REF_PREFIX
+from flax.traverse_util import flatten_dict
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+def _make_state(seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return {
+        'params': {
+            'layer_0': {'kernel': rng.normal(size=(64, 32)).astype(np.float32), 'bias': np.zeros(32, np.float32)},
+            'layer_1': {'kernel': rng.normal(size=(32, 16)).astype(np.float32), 'bias': np.ones(16, np.float32)},
+        },
+        'step': np.array(7),
+    }
+
+
+def _assert_same_state(test: unittest.TestCase, tensors: dict, state: dict):
+    expected = flatten_dict(state)
+    test.assertEqual(set(tensors), set(expected))
+    for key, value in expected.items():
+        np.testing.assert_array_equal(tensors[key], value)
+
+
+class CheckpointFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'ckpt')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write_with_msgpack(self, messages, use_bin_type=True):
+        packer = msgpack.Packer(use_bin_type=use_bin_type)
+        with open(self.path, 'wb') as stream:
+            for message in messages:
+                stream.write(packer.pack(message))
+
+    def test_parser_matches_msgpack_unpacker(self):
+        # every payload header size (fixed, 8, 16 and 32 bits) and a key longer than the first decode window
+        messages = [
+            (('empty',), b''),
+            (('params', 'small'), b'x' * 10),
+            (('params', 'medium'), b'y' * 300),
+            (('params', 'large'), b'z' * 70000),
+            (('k' * 70000, 'kernel'), b'w' * 20),
+        ]
+        self._write_with_msgpack(messages)
+        with open(self.path, 'rb') as stream:
+            expected = [(key, value) for key, value in msgpack.Unpacker(stream, use_list=False, max_buffer_size=0)]
+        self.assertEqual([(key, bytes(value)) for key, value in _iter_ckpt_file(self.path)], expected)
+
+    def test_parser_reads_old_raw_payloads(self):
+        messages = [(('params', 'kernel'), b'x' * 40), (('params', 'bias'), b'y' * 300)]
+        self._write_with_msgpack(messages, use_bin_type=False)
+        self.assertEqual([(key, bytes(value)) for key, value in _iter_ckpt_file(self.path)], messages)
+
+    def test_save_ckpt_matches_msgpack_packer(self):
+        state = _make_state()
+        save_ckpt(state, self.path)
+        with open(self.path, 'rb') as stream:
+            written = stream.read()
+        with open(self.path, 'rb') as stream:
+            messages = list(msgpack.Unpacker(stream, use_list=False, max_buffer_size=0))
+        self.assertEqual(b''.join(msgpack.packb(message) for message in messages), written)
+        _assert_same_state(self, read_ckpt(self.path), state)
+
+    def test_empty_file(self):
+        open(self.path, 'wb').close()
+        self.assertEqual(read_ckpt(self.path), {})
+
+    def test_truncated_file_is_rejected(self):
+        messages = [(('a',), b'x' * 100), (('b' * 50,), b'y' * 100)]
+        _write_ckpt(messages, self.path)
+        with open(self.path, 'rb') as stream:
+            data = stream.read()
+        # inside the last payload, inside its header and inside its key
+        for cut in (len(data) - 1, len(data) - 50, len(data) - 101, len(data) - 130):
+            with open(self.path, 'wb') as stream:
+                stream.write(data[:cut])
+            with self.assertRaises(ValueError, msg=f'cut at {cut}'):
+                list(_iter_ckpt_file(self.path))
+
+    def test_corrupt_file_is_rejected(self):
+        _write_ckpt([(('a',), b'x' * 100), (('b',), b'y' * 100)], self.path)
+        with open(self.path, 'rb') as stream:
+            data = bytearray(stream.read())
+        for position, byte in ((0, 0x00), (data.index(b'b') + 1, 0xc1)):
+            corrupt = bytearray(data)
+            corrupt[position] = byte
+            with open(self.path, 'wb') as stream:
+                stream.write(corrupt)
+            with self.assertRaises(ValueError, msg=f'byte {position}'):
+                list(_iter_ckpt_file(self.path))
+
+
+class CheckpointFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'ckpt')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _first_byte(self):
+        with open(self.path, 'rb') as stream:
+            return stream.read(1)[0]
+
+    def test_v1_round_trip(self):
+        state = _make_state()
+        save_ckpt(state, self.path)
+        self.assertEqual(self._first_byte(), 0x92)
+        _assert_same_state(self, read_ckpt(self.path), state)
+
+    def test_v2_round_trip(self):
+        state = _make_state()
+        save_ckpt(state, self.path, small_tensor_size=1 << 30)
+        self.assertEqual(self._first_byte() & 0xf0, 0x80)
+        _assert_same_state(self, read_ckpt(self.path), state)
+
+    def test_mixed_round_trip(self):
+        # the biases and the step are packed together, the kernels keep a message each
+        state = _make_state()
+        save_ckpt(state, self.path, small_tensor_size=1024)
+        self.assertEqual(self._first_byte() & 0xf0, 0x80)
+        _assert_same_state(self, read_ckpt(self.path), state)
+
+    def test_mixed_round_trip_with_sidecars(self):
+        state = _make_state()
+        save_ckpt(state, self.path, float_dtype='int8', small_tensor_size=1024)
+        tensors = read_ckpt(self.path)
+        self.assertEqual(set(tensors), set(flatten_dict(state)))
+        for key, value in flatten_dict(state).items():
+            np.testing.assert_allclose(tensors[key], value, atol=np.abs(value).max() / 127 + 1e-6)
+
+    def test_header_without_small_tensors(self):
+        state = _make_state()
+        save_ckpt(state, os.path.join(self.directory.name, 'v1'))
+        with open(os.path.join(self.directory.name, 'v1'), 'rb') as stream:
+            messages = stream.read()
+        with open(self.path, 'wb') as stream:
+            stream.write(msgpack.packb({'format': 'v2', 'small_count': 0}) + messages)
+        _assert_same_state(self, read_ckpt(self.path), state)
+
+    def test_unknown_format_is_rejected(self):
+        with open(self.path, 'wb') as stream:
+            stream.write(msgpack.packb({'format': 'v3', 'small_count': 0}))
+        with self.assertRaisesRegex(ValueError, 'v3'):
+            read_ckpt(self.path)
+
+
+@unittest.skipIf(xxhash is None, 'incremental checkpoints require xxhash')
+class IncrementalCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = lambda name: os.path.join(self.directory.name, name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_incremental_round_trip(self):
+        state = _make_state()
+        save_ckpt(state, self.path('base'), hash_tensors=True)
+        state['params']['layer_0']['kernel'] = state['params']['layer_0']['kernel'] + 1
+        save_ckpt(state, self.path('next'), incremental_base=self.path('base'))
+        self.assertLess(os.path.getsize(self.path('next')), os.path.getsize(self.path('base')))
+        _assert_same_state(self, read_ckpt(self.path('next')), state)
+
+    def test_chained_incremental_round_trip(self):
+        states = [_make_state()]
+        save_ckpt(states[0], self.path('ckpt_0'), hash_tensors=True)
+        for i, layer in enumerate(('layer_0', 'layer_1'), start=1):
+            state = _make_state()
+            state['params'][layer]['kernel'] = state['params'][layer]['kernel'] * 2
+            save_ckpt(state, self.path(f'ckpt_{i}'), incremental_base=self.path(f'ckpt_{i - 1}'))
+            states.append(state)
+        for i, state in enumerate(states):
+            _assert_same_state(self, read_ckpt(self.path(f'ckpt_{i}')), state)
+
+    def test_incremental_save_over_its_base_is_rejected(self):
+        state = _make_state()
+        save_ckpt(state, self.path('base'), hash_tensors=True)
+        with self.assertRaises(ValueError):
+            save_ckpt(state, self.path('base'), incremental_base=self.path('base'))
+        _assert_same_state(self, read_ckpt(self.path('base')), state)
+
+    def test_incremental_save_over_a_referenced_file(self):
+        state = _make_state()
+        save_ckpt(state, self.path('ckpt_0'), hash_tensors=True)
+        save_ckpt(state, self.path('ckpt_1'), incremental_base=self.path('ckpt_0'))
+        # every tensor of ckpt_1 lives in ckpt_0, which is overwritten by a save based on ckpt_1
+        save_ckpt(state, self.path('ckpt_0'), incremental_base=self.path('ckpt_1'))
+        _assert_same_state(self, read_ckpt(self.path('ckpt_0')), state)
+
+    def test_reference_cycle_is_rejected(self):
+        _write_ckpt([(('step',), _REF_PREFIX + b'ckpt_1')], self.path('ckpt_0'))
+        _write_ckpt([(('step',), _REF_PREFIX + b'ckpt_0')], self.path('ckpt_1'))
+        with self.assertRaises(ValueError):
+            read_ckpt(self.path('ckpt_0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+import jax
+import numpy as np
+from jax import numpy as jnp
+from fjformer.func.loss_func import cross_entropy_loss_and_accuracy
+
+try:
+    from lib.python.EasyDel.trainer.fsdp_train import chunked_linear_cross_entropy_loss_and_accuracy
+except ModuleNotFoundError:
+    import sys
+    from pathlib import Path
+
+    cp = Path.cwd().__str__()
+    sys.path.append(cp)
+    from lib.python.EasyDel.trainer.fsdp_train import chunked_linear_cross_entropy_loss_and_accuracy
+
+
+class ChunkedLinearCrossEntropyTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        batch_size, seq_length, hidden_dim, vocab_size = 3, 10, 8, 16
+        self.hidden_states = jnp.asarray(rng.normal(size=(batch_size, seq_length, hidden_dim)), jnp.float32)
+        self.kernel = jnp.asarray(rng.normal(size=(hidden_dim, vocab_size)), jnp.float32)
+        self.bias = jnp.asarray(rng.normal(size=(vocab_size,)), jnp.float32)
+        self.labels = jnp.asarray(rng.integers(0, vocab_size, size=(batch_size, seq_length)), jnp.int32)
+        weights = np.ones((batch_size, seq_length), np.float32)
+        # a padded tail and a row with no token counted at all
+        weights[1, 6:] = 0
+        weights[2] = 0
+        self.weights = jnp.asarray(weights)
+
+    def _reference(self, hidden_states, kernel, bias):
+        return cross_entropy_loss_and_accuracy(hidden_states @ kernel + bias, self.labels, self.weights)
+
+    def test_matches_cross_entropy_on_full_logits(self):
+        expected_loss, expected_accuracy = self._reference(self.hidden_states, self.kernel, self.bias)
+        # one chunk, chunks dividing the sequence and a padded last chunk
+        for chunk_size in (16, 5, 4):
+            loss, accuracy = chunked_linear_cross_entropy_loss_and_accuracy(
+                self.hidden_states, self.kernel, self.labels, self.weights, chunk_size=chunk_size, bias=self.bias
+            )
+            np.testing.assert_allclose(loss, expected_loss, rtol=1e-5, err_msg=f'chunk_size {chunk_size}')
+            np.testing.assert_allclose(accuracy, expected_accuracy, rtol=1e-5, err_msg=f'chunk_size {chunk_size}')
+
+    def test_without_bias(self):
+        expected_loss, expected_accuracy = self._reference(self.hidden_states, self.kernel, 0)
+        loss, accuracy = chunked_linear_cross_entropy_loss_and_accuracy(
+            self.hidden_states, self.kernel, self.labels, self.weights, chunk_size=3
+        )
+        np.testing.assert_allclose(loss, expected_loss, rtol=1e-5)
+        np.testing.assert_allclose(accuracy, expected_accuracy, rtol=1e-5)
+
+    def test_gradients_match(self):
+        def chunked(hidden_states, kernel, bias):
+            return chunked_linear_cross_entropy_loss_and_accuracy(
+                hidden_states, kernel, self.labels, self.weights, chunk_size=4, bias=bias
+            )[0]
+
+        def reference(hidden_states, kernel, bias):
+            return self._reference(hidden_states, kernel, bias)[0]
+
+        grads = jax.grad(chunked, argnums=(0, 1, 2))(self.hidden_states, self.kernel, self.bias)
+        expected = jax.grad(reference, argnums=(0, 1, 2))(self.hidden_states, self.kernel, self.bias)
+        for grad, expected_grad in zip(grads, expected):
+            np.testing.assert_allclose(grad, expected_grad, rtol=1e-4, atol=1e-6)
+        # nothing flows back into the tokens that do not count
+        np.testing.assert_array_equal(grads[0][2], 0)
+        np.testing.assert_array_equal(grads[0][1, 6:], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import unittest
+
+import jax
+import numpy as np
+from jax import lax
+from jax import numpy as jnp
+
+try:
+    from lib.python.EasyDel.modules.opt import FlaxOPTForCausalLM, OPTConfig
+except ModuleNotFoundError:
+    import sys
+    from pathlib import Path
+
+    cp = Path.cwd().__str__()
+    sys.path.append(cp)
+    from lib.python.EasyDel.modules.opt import FlaxOPTForCausalLM, OPTConfig
+
+MAX_LENGTH = 8
+
+
+def _make_model():
+    config = OPTConfig(
+        vocab_size=64,
+        hidden_size=16,
+        num_hidden_layers=2,
+        ffn_dim=32,
+        num_attention_heads=2,
+        max_position_embeddings=32,
+        dropout=0.0,
+    )
+    return FlaxOPTForCausalLM(config, input_shape=(1, MAX_LENGTH), seed=0)
+
+
+def _is_tracer(tree):
+    return any(isinstance(leaf, jax.core.Tracer) for leaf in jax.tree_util.tree_leaves(tree))
+
+
+class OPTGenerationInputsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = _make_model()
+
+    def setUp(self):
+        self.model._kv_cache_cache.clear()
+
+    def _assert_baseline_inputs(self, input_ids, attention_mask):
+        # the masks and positions the unfused cumsum + update slice produced before
+        inputs = self.model.prepare_inputs_for_generation(input_ids, MAX_LENGTH, attention_mask=attention_mask)
+        expected_mask = lax.dynamic_update_slice(
+            jnp.ones((input_ids.shape[0], MAX_LENGTH), dtype="i4"), attention_mask.astype("i4"), (0, 0)
+        )
+        np.testing.assert_array_equal(inputs["attention_mask"], expected_mask)
+        np.testing.assert_array_equal(inputs["position_ids"], attention_mask.cumsum(-1) - 1)
+        self.assertEqual(inputs["attention_mask"].shape, (input_ids.shape[0], MAX_LENGTH))
+        return inputs
+
+    def test_left_padded_mask(self):
+        attention_mask = jnp.array([[0, 0, 1, 1, 1], [1, 1, 1, 1, 1]], dtype="i4")
+        self._assert_baseline_inputs(jnp.ones((2, 5), dtype="i4"), attention_mask)
+
+    def test_pre_padded_mask(self):
+        attention_mask = jnp.array([[0, 1, 1, 1, 0, 0, 0, 0], [1, 1, 1, 1, 1, 1, 0, 0]], dtype="i4")
+        inputs = self._assert_baseline_inputs(jnp.ones((2, MAX_LENGTH), dtype="i4"), attention_mask)
+        np.testing.assert_array_equal(inputs["attention_mask"], attention_mask)
+
+    def test_without_mask(self):
+        inputs = self.model.prepare_inputs_for_generation(jnp.ones((2, 5), dtype="i4"), MAX_LENGTH)
+        np.testing.assert_array_equal(inputs["attention_mask"], jnp.ones((2, MAX_LENGTH), dtype="i4"))
+        np.testing.assert_array_equal(inputs["position_ids"], jnp.broadcast_to(jnp.arange(5), (2, 5)))
+
+    def test_update_inputs_for_generation(self):
+        attention_mask = jnp.array([[0, 0, 1, 1, 1]], dtype="i4")
+        inputs = self.model.prepare_inputs_for_generation(jnp.ones((1, 5), dtype="i4"), MAX_LENGTH, attention_mask)
+        outputs = self.model(
+            jnp.ones((1, 5), dtype="i4"),
+            attention_mask=inputs["attention_mask"],
+            position_ids=inputs["position_ids"],
+            past_key_values=inputs["past_key_values"],
+        )
+        for step in range(1, 3):
+            inputs = self.model.update_inputs_for_generation(outputs, inputs)
+            np.testing.assert_array_equal(inputs["position_ids"], [[2 + step]])
+
+    def test_same_shape_reuses_the_zero_cache(self):
+        input_ids = jnp.ones((2, 5), dtype="i4")
+        first = self.model.prepare_inputs_for_generation(input_ids, MAX_LENGTH)["past_key_values"]
+        second = self.model.prepare_inputs_for_generation(input_ids, MAX_LENGTH)["past_key_values"]
+        for leaf, other in zip(jax.tree_util.tree_leaves(first), jax.tree_util.tree_leaves(second)):
+            self.assertIs(leaf, other)
+            np.testing.assert_array_equal(leaf, 0)
+        # a different shape replaces the cached one instead of piling up
+        self.model.prepare_inputs_for_generation(jnp.ones((1, 5), dtype="i4"), MAX_LENGTH)
+        self.assertEqual(list(self.model._kv_cache_cache), [(1, MAX_LENGTH, self.model.dtype)])
+
+    def test_cache_created_under_jit_does_not_leak(self):
+        traced = jax.jit(
+            lambda input_ids: self.model.prepare_inputs_for_generation(input_ids, MAX_LENGTH)["past_key_values"]
+        )
+        traced(jnp.ones((2, 5), dtype="i4"))
+        self.assertFalse(any(_is_tracer(cache) for cache in self.model._kv_cache_cache.values()))
+        for _ in range(2):
+            cache = self.model.prepare_inputs_for_generation(jnp.ones((2, 5), dtype="i4"), MAX_LENGTH)
+            self.assertFalse(_is_tracer(cache["past_key_values"]))
+        # and the compiled call itself hands back concrete arrays
+        self.assertFalse(_is_tracer(traced(jnp.ones((2, 5), dtype="i4"))))
+
+
+class OPTAttentionPathTest(unittest.TestCase):
+    def test_prefill_matches_the_no_cache_forward(self):
+        model = _make_model()
+        input_ids = jnp.array([[5, 6, 7, 8, 9], [10, 11, 12, 13, 14]], dtype="i4")
+        attention_mask = jnp.array([[0, 0, 1, 1, 1], [1, 1, 1, 1, 1]], dtype="i4")
+        inputs = model.prepare_inputs_for_generation(input_ids, MAX_LENGTH, attention_mask=attention_mask)
+        cached = model(
+            input_ids,
+            attention_mask=inputs["attention_mask"],
+            position_ids=inputs["position_ids"],
+            past_key_values=inputs["past_key_values"],
+        ).logits
+        uncached = model(input_ids, attention_mask=attention_mask, position_ids=inputs["position_ids"]).logits
+        self.assertEqual(uncached.shape, (2, 5, 64))
+        valid = np.asarray(attention_mask, dtype=bool)
+        np.testing.assert_allclose(np.asarray(cached)[valid], np.asarray(uncached)[valid], atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()